@@ -8,11 +8,10 @@ Re-synthesize video A using the segments of video B.
 
 By Ben Lacker, 2009-02-24.
 """
-import numpy
 import sys
 import time
 
-from echonest.remix import action, audio, video
+from echonest.remix import action, audio, matching, video
 
 usage="""
 Usage:
@@ -45,46 +44,6 @@ class AfromB(object):
         self.segs_b = self.input_b.analysis.segments
         self.output_filename = output_filename
     
-    def calculate_distances(self, a):
-        distance_matrix = numpy.zeros((len(self.segs_b), 4), dtype=numpy.float32)
-        pitch_distances = []
-        timbre_distances = []
-        loudmax_distances = []
-        for b in self.segs_b:
-            pitch_diff = numpy.subtract(b.pitches,a.pitches)
-            pitch_distances.append(numpy.sum(numpy.square(pitch_diff)))
-            timbre_diff = numpy.subtract(b.timbre,a.timbre)
-            timbre_distances.append(numpy.sum(numpy.square(timbre_diff)))
-            loudmax_diff = b.loudness_begin - a.loudness_begin
-            loudmax_distances.append(numpy.square(loudmax_diff))
-        distance_matrix[:,0] = pitch_distances
-        distance_matrix[:,1] = timbre_distances
-        distance_matrix[:,2] = loudmax_distances
-        distance_matrix[:,3] = range(len(self.segs_b))
-        distance_matrix = self.normalize_distance_matrix(distance_matrix)
-        return distance_matrix
-    
-    def normalize_distance_matrix(self, mat, mode='minmed'):
-        """ Normalize a distance matrix on a per column basis.
-        """
-        if mode == 'minstd':
-            mini = numpy.min(mat,0)
-            m = numpy.subtract(mat, mini)
-            std = numpy.std(mat,0)
-            m = numpy.divide(m, std)
-            m = numpy.divide(m, mat.shape[1])
-        elif mode == 'minmed':
-            mini = numpy.min(mat,0)
-            m = numpy.subtract(mat, mini)
-            med = numpy.median(m)
-            m = numpy.divide(m, med)
-            m = numpy.divide(m, mat.shape[1])
-        elif mode == 'std':
-            std = numpy.std(mat,0)
-            m = numpy.divide(mat, std)
-            m = numpy.divide(m, mat.shape[1])
-        return m
-    
     def run(self, mix=0.5, envelope=False):
         dur = len(self.input_a.data) + 100000 # another two seconds
         # determine shape of new array. 
@@ -94,12 +53,11 @@ class AfromB(object):
         self.input_a = action.make_mono(self.input_a)
         self.input_b = action.make_mono(self.input_b)
         out = audio.AudioData(shape=new_shape, sampleRate=self.input_b.sampleRate, numChannels=new_channels)
-        for a in self.segs_a:
+        # find best match from segs in B for every seg in A
+        matches, distances = matching.match_segments(self.segs_a, self.segs_b)
+        for a, match_index in zip(self.segs_a, matches[:, 0]):
             seg_index = a.absolute_context()[0]
-            # find best match from segs in B
-            distance_matrix = self.calculate_distances(a)
-            distances = [numpy.sqrt(x[0]+x[1]+x[2]) for x in distance_matrix]
-            match = self.segs_b[distances.index(min(distances))]
+            match = self.segs_b[match_index]
             segment_data = self.input_b[match]
             reference_data = self.input_a[a]
             if segment_data.endindex < reference_data.endindex:
@@ -1 +1 @@
-__all__ = [ 'action', 'audio', 'local_db', 'modify', 'support', 'video' ]
+__all__ = [ 'action', 'audio', 'batch', 'jumpgraph', 'local_db', 'matching', 'modify', 'similarity', 'support', 'video' ]
@@ -14,7 +14,7 @@ Additional functions and cleanup by Peter Sobot on 2012-11-01.
 :group Effects: AudioEffect, LevelDB, AmplitudeFactor, TimeTruncateFactor, TimeTruncateLength, Simultaneous
 :group Exception Classes: FileTypeError, EchoNestRemixError
 
-:group Audio helper functions: getpieces, mix, assemble, megamix
+:group Audio helper functions: getpieces, mix, assemble, megamix, truncatemix, MixBus
 :group Utility functions: _dataParser, _attributeParser, _segmentsParser
 
 .. _Analyze API: http://developer.echonest.com/
@@ -25,7 +25,6 @@ Additional functions and cleanup by Peter Sobot on 2012-11-01.
 __version__ = "$Revision: 0 $"
 # $Source$
 
-import hashlib
 import numpy
 import os
 import sys
@@ -43,21 +42,58 @@ import cStringIO
 import xml.etree.ElementTree as etree
 import xml.dom.minidom as minidom
 import weakref
+import threading
+import multiprocessing
+from multiprocessing.pool import ThreadPool
 
 from pyechonest import track
 from pyechonest.util import EchoNestAPIError
 import pyechonest.util
 import pyechonest.config as config
 
-from support.ffmpeg import ffmpeg, ffmpeg_downconvert
+from support.ffmpeg import ffmpeg, ffmpeg_downconvert, ffmpeg_encode, STREAM_BLOCK_SIZE
+from support import instrument
 from local_db import check_and_create_local_db
 from local_db import check_db
+from local_db import file_md5
+from local_db import has_audio
+from local_db import has_analysis
 from local_db import save_to_local
 from local_db import get_audio_file
 from local_db import get_analysis_file
+from local_db import load_analysis
+from local_db import event_columns
+
+try:
+    from cAction import limit as _limit
+except ImportError:
+    _limit = None
 
 MP3_BITRATE = 128
 
+# Map 16-bit WAVE files into memory (copy-on-write) instead of reading them.
+# Can be monkey-patched to False to always read the samples into memory.
+MMAP_WAV = True
+
+# Number of threads `RenderPlan` uses to load and mix several sources at once.
+# Can be monkey-patched to 1 to render one source at a time.
+RENDER_THREADS = multiprocessing.cpu_count()
+
+# Plans that copy fewer frames than this from loaded sources render on the
+# calling thread: handing them to the pool costs more than it saves.
+RENDER_MIN_FRAMES = 10 * 44100
+
+# Sources rendered in parallel sum into the output in stripes of this many
+# frames, each guarded by one of RENDER_LOCKS locks.
+RENDER_STRIPE = 65536
+RENDER_LOCKS = 64
+
+# Segments starting within this many seconds of a beat (or other quantum) are
+# taken to be its attack, when `AudioAnalysis.resample` lines the two up; if
+# there are none, quanta are assumed to start this long before their attacks.
+FUSION_INTERVAL = .06
+AVG_PEAK_OFFSET = 0.025
+
 log = logging.getLogger(__name__)
 logging.basicConfig(level=logging.INFO)
 
@@ -110,14 +146,19 @@ class AudioAnalysis(object):
                             representing either a filename, track ID, or MD5, or \
                             instead, a file-like object.")
 
+        # Columns of an analysis loaded from the local db, if any.
+        self._columns = None
         try:
             if isinstance(initializer, basestring):
                 # see if path_or_identifier is a path or an ID
                 if os.path.isfile(initializer): 
                     # read from the local analysis file
                     if fromLocal:
-                        with open(initializer, 'rb') as f:
-                            track_dict = json.loads(f.read())
+                        if initializer.endswith('.npz'):
+                            track_dict, self._columns = load_analysis(initializer, mmap_mode='c')
+                        else:
+                            with open(initializer, 'rb') as f:
+                                track_dict = json.loads(f.read())
                         self.pyechonest_track = track.Track(track_dict['id'], track_dict['md5'], track_dict)
                     # read from the actual file and send it for analysis
                     if not fromLocal:
@@ -220,38 +261,118 @@ class AudioAnalysis(object):
         for attribute in ('end_of_fade_in', 'start_of_fade_out', 'duration', 'loudness'):
             setattr(self, attribute, getattr(self.pyechonest_track, attribute))
 
+    # Search indexes over the lists of quanta, built on demand by `_index`.
+    _indexes = None
+
+    def _index(self, kind):
+        """
+        Returns a `_QuantumIndex` over one kind of event, e.g. 'tatums',
+        rebuilding it if the list has changed since it was last used.
+        """
+        quanta = getattr(self, kind)
+        if self._indexes is None:
+            self._indexes = {}
+        index = self._indexes.get(kind)
+        if index is None or not index.is_current(quanta):
+            index = self._indexes[kind] = _QuantumIndex(quanta)
+        return index
+
+    # Segment features resampled by `resample`, by (level, feature).
+    _resampled = None
+
+    def resample(self, level='tatums', feature='timbre'):
+        """
+        Resamples a segment feature, such as 'timbre' or 'pitches', to one of
+        the rhythmic levels 'tatums', 'beats', 'bars', 'sections' or
+        'segments'. Each row is the average of the feature over one quantum,
+        weighted by how much of the quantum each segment covers.
+
+        Only quanta and segments between the end of the fade-in and the start
+        of the fade-out are used. The quanta are first moved earlier by the
+        mean distance from their starts to the nearby segment attacks.
+
+        Returns a read-only float32 matrix, with a row for each of those
+        quanta but the last, and the index in the `level` list of the first
+        of them. If there are fewer than two segments or quanta, the matrix
+        has no rows. Results are cached until the lists change.
+        """
+        segments = self.segments
+        markers = getattr(self, level)
+        versions = (segments._version, markers._version)
+        if self._resampled is None:
+            self._resampled = {}
+        cached = self._resampled.get((level, feature))
+        if cached is not None and cached[0] == versions:
+            return cached[1], cached[2]
+
+        def central(quanta):
+            starts = numpy.asarray(quanta.start, dtype=numpy.float64)
+            durations = numpy.asarray(quanta.durations, dtype=numpy.float64)
+            inside = numpy.nonzero((self.end_of_fade_in <= starts) &
+                                   (starts + durations < self.start_of_fade_out))[0]
+            return starts[inside], durations[inside], inside
+
+        starts, durations, inside = central(segments)
+        values = numpy.asarray(getattr(segments, feature), dtype=numpy.float64)[inside]
+        marker_starts, marker_durations, marker_inside = central(markers)
+        index = int(marker_inside[0]) if len(marker_inside) else 0
+        if len(starts) < 2 or len(marker_starts) < 2:
+            matrix = numpy.zeros((0,) + values.shape[1:], dtype=numpy.float32)
+        else:
+            if level == 'segments':
+                offset = 0.0
+            else:
+                offset = _attack_offset(starts, marker_starts)
+            marker_starts = numpy.maximum(marker_starts - offset, 0)
+            matrix = _resample(starts, durations, values,
+                               marker_starts[:-1], marker_durations[:-1])
+        matrix = _read_only(matrix)
+        self._resampled[(level, feature)] = (versions, matrix, index)
+        return matrix, index
+
+    def _event_columns(self, kind):
+        """
+        Returns a dict of the columns (see `local_db.event_columns`) of one kind
+        of event in the analysis, e.g. 'segments'.
+        """
+        if self._columns is not None:
+            prefix = kind + '.'
+            return dict((name[len(prefix):], column) for name, column in self._columns.items()
+                        if name.startswith(prefix))
+        return event_columns(kind, getattr(self.pyechonest_track, kind))
+
     @property
     def bars(self):
         if self._bars is None:
-            self._bars = _dataParser('bar', self.pyechonest_track.bars)
+            self._bars = _columnsParser('bar', self._event_columns('bars'))
             self._bars.attach(self)
         return self._bars
 
     @property
     def beats(self):
         if self._beats is None:
-            self._beats = _dataParser('beat', self.pyechonest_track.beats)
+            self._beats = _columnsParser('beat', self._event_columns('beats'))
             self._beats.attach(self)
         return self._beats
 
     @property
     def tatums(self):
         if self._tatums is None:
-            self._tatums = _dataParser('tatum', self.pyechonest_track.tatums)
+            self._tatums = _columnsParser('tatum', self._event_columns('tatums'))
             self._tatums.attach(self)
         return self._tatums
 
     @property
     def sections(self):
         if self._sections is None:
-            self._sections = _attributeParser('section', self.pyechonest_track.sections)
+            self._sections = _columnsParser('section', self._event_columns('sections'))
             self._sections.attach(self)
         return self._sections
 
     @property
     def segments(self):
         if self._segments is None:
-            self._segments = _segmentsParser(self.pyechonest_track.segments)
+            self._segments = _columnsParser('segment', self._event_columns('segments'))
             self._segments.attach(self)
         return self._segments
 
@@ -275,6 +396,8 @@ class AudioRenderable(object):
     duration
         An accessor returning the rhythmic duration (in seconds) of the audio object.
     """
+    __slots__ = ()
+
     def resolve_source(self, alt):
         """
         Given an alternative, fallback `alt` source, return either `self`'s
@@ -314,6 +437,19 @@ class AudioRenderable(object):
     def sources(self):
         return set([self.source])
 
+    def compile(self, start=0.0):
+        """
+        Returns a `RenderPlan` for rendering the object at `start` seconds:
+        the source sample ranges, gains and offsets it is made of, worked out
+        without rendering anything. The plan's `render`\() or `encode`\()
+        then produce the audio in one pass, without the intermediate
+        `AudioData` objects that nested `render`\() calls create.
+        """
+        source = self.source
+        plan = RenderPlan(source.sampleRate, source.numChannels)
+        plan.add_renderable(self, start)
+        return plan
+
     def encode(self, filename):
         """
         Shortcut function that takes care of the need to obtain an `AudioData`
@@ -336,6 +472,10 @@ class AudioData(AudioRenderable):
 
     .. _numpy.array: http://docs.scipy.org/doc/numpy/reference/generated/numpy.array.html
     """
+    # Spare capacity behind `data`; see `pad_with_zeros`.
+    _buffer = None
+    _view = None
+
     def __init__(self, filename=None, ndarray=None, shape=None, sampleRate=None, numChannels=None, defer=False, verbose=True):
         """
         Given an input `ndarray`, import the sample values and shape
@@ -388,22 +528,11 @@ class AudioData(AudioRenderable):
                     numChannels=self.numChannels, sampleRate=self.sampleRate, verbose=self.verbose)
             file_to_read = self.convertedfile
 
-        w = wave.open(file_to_read, 'r')
-        numFrames = w.getnframes()
-        raw = w.readframes(numFrames)
-        sampleSize = numFrames * self.numChannels
-        data = numpy.frombuffer(raw, dtype="<h", count=sampleSize)
-        ndarray = numpy.array(data, dtype=numpy.int16)
-        if self.numChannels > 1:
-            ndarray.resize((numFrames, self.numChannels))
-        self.data = numpy.zeros(ndarray.shape, dtype=numpy.int16)
-        self.endindex = 0
-        if ndarray is not None:
-            self.endindex = len(ndarray)
-            self.data = ndarray
+        ndarray = _read_wav(file_to_read)
+        self.endindex = len(ndarray)
+        self.data = ndarray
         if temp_file_handle is not None:
             os.close(temp_file_handle)
-        w.close()
 
     def __getitem__(self, index):
         """
@@ -453,13 +582,40 @@ class AudioData(AudioRenderable):
             return AudioData(None, self.data[index], defer=False)
 
     def pad_with_zeros(self, num_samples):
+        """
+        Lengthens `data` by `num_samples` samples of silence.
+
+        `data` is kept as the front of a larger buffer whose capacity doubles
+        whenever it runs out, so that growing an `AudioData` a piece at a
+        time costs linear rather than quadratic time. `trim`\() gives back
+        the unused capacity.
+        """
         if num_samples > 0:
-            if self.numChannels == 1:
-                extra_shape = (num_samples,)
+            length = len(self.data)
+            new_length = length + num_samples
+            buf = self._buffer
+            if buf is None or self.data is not self._view or len(buf) < new_length:
+                capacity = max(new_length, 2 * length)
+                buf = numpy.zeros((capacity,) + self.data.shape[1:], dtype=self.data.dtype)
+                buf[:length] = self.data
+                self._buffer = buf
             else:
-                extra_shape = (num_samples, self.numChannels)
-            self.data = numpy.append(self.data,
-                                     numpy.zeros(extra_shape, dtype=numpy.int16), axis=0)
+                buf[length:new_length] = 0
+            self.data = self._view = buf[:new_length]
+
+    def trim(self):
+        "Releases any capacity that `pad_with_zeros` reserved beyond `data`."
+        if self._buffer is not None:
+            if self.data is self._view and len(self._buffer) > len(self.data):
+                self.data = self.data.copy()
+            self._buffer = self._view = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for key in ('_buffer', '_view'):
+            if key in state:
+                del state[key]
+        return state
 
     def append(self, another_audio_data):
         "Appends the input to the end of this `AudioData`."
@@ -506,61 +662,20 @@ class AudioData(AudioRenderable):
         """
         Outputs an MP3 or WAVE file to `filename`.
         Format is determined by `mp3` parameter.
-        """
-        if not mp3 and filename.lower().endswith('.wav'):
-            mp3 = False
-        else:
-            mp3 = True
-        if mp3:
-            foo, tempfilename = tempfile.mkstemp(".wav")
-            os.close(foo)
-        else:
-            tempfilename = filename
-        fid = open(tempfilename, 'wb')
-        # Based on Scipy svn
-        # http://projects.scipy.org/pipermail/scipy-svn/2007-August/001189.html
-        fid.write('RIFF')
-        fid.write(struct.pack('<i', 0))  # write a 0 for length now, we'll go back and add it later
-        fid.write('WAVE')
-        # fmt chunk
-        fid.write('fmt ')
-        if self.data.ndim == 1:
-            noc = 1
-        else:
-            noc = self.data.shape[1]
-        bits = self.data.dtype.itemsize * 8
-        sbytes = self.sampleRate * (bits / 8) * noc
-        ba = noc * (bits / 8)
-        fid.write(struct.pack('<ihHiiHH', 16, 1, noc, self.sampleRate, sbytes, ba, bits))
-        # data chunk
-        fid.write('data')
-        fid.write(struct.pack('<i', self.data.nbytes))
-        self.data.tofile(fid)
-        # Determine file size and place it in correct
-        # position at start of the file.
-        size = fid.tell()
-        fid.seek(4)
-        fid.write(struct.pack('<i', size - 8))
-        fid.close()
-        if not mp3:
-            return tempfilename
-        # now convert it to mp3
-        if not filename.lower().endswith('.mp3'):
-            filename = filename + '.mp3'
-        try:
-            bitRate = MP3_BITRATE
-        except NameError:
-            bitRate = 128
 
+        MP3s are encoded by streaming the samples into ffmpeg, without
+        writing a temporary WAVE file.
+        """
+        self.trim()
+        data = self.data
+        filename, mp3 = _output_format(filename, mp3)
         try:
-            ffmpeg(tempfilename, filename, bitRate=bitRate, verbose=self.verbose)
-        except:
-            log.warning("Error converting from %s to %s", tempfilename, filename)
-
-        if tempfilename != filename:
-            if self.verbose:
-                log.warning(sys.stderr, "Deleting: %s", tempfilename)
-            os.remove(tempfilename)
+            _encode_blocks(filename, mp3, _blocks(data), self.sampleRate,
+                           _channels(data), len(data), self.verbose)
+        except (RuntimeError, EnvironmentError):
+            if not mp3:
+                raise
+            log.warning("Error converting to %s", filename)
         return filename
 
     def unload(self):
@@ -601,15 +716,16 @@ class AudioData32(AudioData):
         self.sampleRate = sampleRate
         self.numChannels = numChannels
         self.convertedfile = None
+        self.endindex = 0
         if shape is None and isinstance(ndarray, numpy.ndarray) and not self.defer:
             self.data = numpy.zeros(ndarray.shape, dtype=numpy.int32)
         elif shape is not None and not self.defer:
             self.data = numpy.zeros(shape, dtype=numpy.int32)
         elif not self.defer and self.filename:
+            self.data = None
             self.load()
         else:
             self.data = None
-        self.endindex = 0
         if ndarray is not None and self.data is not None:
             self.endindex = len(ndarray)
             self.data[0:self.endindex] = ndarray
@@ -628,138 +744,662 @@ class AudioData32(AudioData):
                     numChannels=self.numChannels, sampleRate=self.sampleRate, verbose=self.verbose)
             file_to_read = self.convertedfile
 
-        w = wave.open(file_to_read, 'r')
-        numFrames = w.getnframes()
-        raw = w.readframes(numFrames)
-        sampleSize = numFrames * self.numChannels
-        data = numpy.frombuffer(raw, dtype="<h", count=sampleSize)
-        ndarray = numpy.array(data, dtype=numpy.int16)
-        if self.numChannels > 1:
-            ndarray.resize((numFrames, self.numChannels))
-        self.data = numpy.zeros(ndarray.shape, dtype=numpy.int32)
-        self.endindex = 0
-        if ndarray is not None:
-            self.endindex = len(ndarray)
-            self.data[0:self.endindex] = ndarray
+        ndarray = _read_wav(file_to_read)
+        self.endindex = len(ndarray)
+        self.data = numpy.array(ndarray, dtype=numpy.int32)
         if temp_file_handle is not None:
             os.close(temp_file_handle)
-        w.close()
 
     def encode(self, filename=None, mp3=None):
         """
         Outputs an MP3 or WAVE file to `filename`.
         Format is determined by `mp3` parameter.
-        """
-        normalized = self.normalized()
-        temp_file_handle = None
-        if not mp3 and filename.lower().endswith('.wav'):
-            mp3 = False
-        else:
-            mp3 = True
-        if mp3:
-            temp_file_handle, tempfilename = tempfile.mkstemp(".wav")
-        else:
-            tempfilename = filename
-        fid = open(tempfilename, 'wb')
-        # Based on Scipy svn
-        # http://projects.scipy.org/pipermail/scipy-svn/2007-August/001189.html
-        fid.write('RIFF')
-        fid.write(struct.pack('<i', 0))  # write a 0 for length now, we'll go back and add it later
-        fid.write('WAVE')
-        # fmt chunk
-        fid.write('fmt ')
-        if normalized.ndim == 1:
-            noc = 1
-        else:
-            noc = normalized.shape[1]
-        bits = normalized.dtype.itemsize * 8
-        sbytes = self.sampleRate * (bits / 8) * noc
-        ba = noc * (bits / 8)
-        fid.write(struct.pack('<ihHiiHH', 16, 1, noc, self.sampleRate, sbytes, ba, bits))
-        # data chunk
-        fid.write('data')
-        fid.write(struct.pack('<i', normalized.nbytes))
-        normalized.tofile(fid)
-        # Determine file size and place it in correct
-        # position at start of the file.
-        size = fid.tell()
-        fid.seek(4)
-        fid.write(struct.pack('<i', size - 8))
-        fid.close()
-        if not mp3:
-            return tempfilename
-        # now convert it to mp3
-        if not filename.lower().endswith('.mp3'):
-            filename = filename + '.mp3'
-        try:
-            bitRate = MP3_BITRATE
-        except NameError:
-            bitRate = 128
-        ffmpeg(tempfilename, filename, bitRate=bitRate, verbose=self.verbose)
-        if tempfilename != filename:
-            if self.verbose:
-                log.info("Deleting: %s", tempfilename)
-            os.remove(tempfilename)
-        if temp_file_handle is not None:
-            os.close(temp_file_handle)
+
+        The samples are normalized to 16 bits a block at a time and MP3s are
+        encoded by streaming them into ffmpeg, so neither a 16-bit copy of
+        the data nor a temporary WAVE file is made.
+        """
+        self.trim()
+        data = self.data
+        factor = self._normalize_factor()
+        blocks = (self._normalize(block, factor) for block in _blocks(data))
+        filename, mp3 = _output_format(filename, mp3)
+        _encode_blocks(filename, mp3, blocks, self.sampleRate,
+                       _channels(data), len(data), self.verbose)
         return filename
 
     def normalized(self):
         """Return to 16-bit for encoding."""
-        factor = 32767.0 / numpy.max(numpy.absolute(self.data.flatten()))
+        return self._normalize(self.data, self._normalize_factor())
+
+    def _normalize_factor(self):
+        "The factor by which `normalized` scales the data."
+        return 32767.0 / max(numpy.max(numpy.absolute(block)) for block in _blocks(self.data))
+
+    @staticmethod
+    def _normalize(data, factor):
         # If the max was 32768, don't bother scaling:
         if factor < 1.000031:
-            return (self.data * factor).astype(numpy.int16)
+            return (data * factor).astype(numpy.int16)
         else:
-            return self.data.astype(numpy.int16)
+            return data.astype(numpy.int16)
 
-    def pad_with_zeros(self, num_samples):
-        if num_samples > 0:
-            if self.numChannels == 1:
-                extra_shape = (num_samples,)
+
+def _blocks(data, blockSize=STREAM_BLOCK_SIZE):
+    "Yields successive views of `blockSize` samples of `data`."
+    for start in xrange(0, len(data), blockSize):
+        yield data[start:start + blockSize]
+
+
+def _channels(data):
+    "The number of channels in an array of samples."
+    if data.ndim == 1:
+        return 1
+    return data.shape[1]
+
+
+def _output_format(filename, mp3):
+    "Returns the name of the file to encode to, and whether it is an MP3."
+    if not mp3 and filename.lower().endswith('.wav'):
+        return filename, False
+    if not filename.lower().endswith('.mp3'):
+        filename = filename + '.mp3'
+    return filename, True
+
+
+def _encode_blocks(filename, mp3, blocks, sampleRate, numChannels, numFrames, verbose=True):
+    """
+    Writes `numFrames` frames of 16-bit samples, given as an iterable of
+    `blocks`, to a WAVE file, or if `mp3` streams them through ffmpeg into
+    an MP3 file.
+    """
+    if not mp3:
+        start = time.time()
+        peak = 0
+        # Written next to `filename` and renamed over it, as `filename` may
+        # be the source of a memory-mapped AudioData (see `_read_wav`):
+        # truncating a mapped file kills the process with SIGBUS.
+        fd, temp_file = tempfile.mkstemp('.wav', dir=os.path.dirname(os.path.abspath(filename)))
+        fid = os.fdopen(fd, 'wb')
+        try:
+            # Based on Scipy svn
+            # http://projects.scipy.org/pipermail/scipy-svn/2007-August/001189.html
+            fid.write('RIFF')
+            fid.write(struct.pack('<i', 0))  # write a 0 for length now, we'll go back and add it later
+            fid.write('WAVE')
+            # fmt chunk
+            fid.write('fmt ')
+            noc = numChannels
+            bits = 16
+            sbytes = sampleRate * (bits / 8) * noc
+            ba = noc * (bits / 8)
+            fid.write(struct.pack('<ihHiiHH', 16, 1, noc, sampleRate, sbytes, ba, bits))
+            # data chunk
+            fid.write('data')
+            fid.write(struct.pack('<i', numFrames * ba))
+            for block in blocks:
+                block = block.astype('<i2', copy=False)
+                peak = max(peak, block.nbytes)
+                block.tofile(fid)
+            # Determine file size and place it in correct
+            # position at start of the file.
+            size = fid.tell()
+            fid.seek(4)
+            fid.write(struct.pack('<i', size - 8))
+            fid.close()
+            # mkstemp makes the file private; give it the usual permissions.
+            umask = os.umask(0)
+            os.umask(umask)
+            os.chmod(temp_file, 0666 & ~umask)
+            os.rename(temp_file, filename)
+        except:
+            if not fid.closed:
+                fid.close()
+            os.remove(temp_file)
+            raise
+        instrument.record('encode', start, bytes=size, peak=peak, file=filename)
+        return
+    # now stream it into an mp3
+    try:
+        bitRate = MP3_BITRATE
+    except NameError:
+        bitRate = 128
+    ffmpeg_encode(blocks, filename, inSampleRate=sampleRate, inChannels=numChannels,
+                  bitRate=bitRate, verbose=verbose)
+
+
+def _wav_data_chunk(filename):
+    """
+    Returns the byte offset and length of the data chunk of a RIFF WAVE file.
+    """
+    with open(filename, 'rb') as f:
+        riff, size, wave_id = struct.unpack('<4sI4s', f.read(12))
+        if riff != 'RIFF' or wave_id != 'WAVE':
+            raise FileTypeError(filename, 'Not a RIFF WAVE file')
+        while True:
+            header = f.read(8)
+            if len(header) < 8:
+                raise FileTypeError(filename, 'WAVE file has no data chunk')
+            chunk_id, size = struct.unpack('<4sI', header)
+            if chunk_id == 'data':
+                return f.tell(), size
+            # Chunks are padded to an even number of bytes.
+            f.seek(size + (size & 1), os.SEEK_CUR)
+
+
+def _read_wav(filename):
+    """
+    Returns the samples of a 16-bit PCM WAVE file as an int16 array of shape
+    (frames, channels), or (frames,) for mono files.
+
+    If `MMAP_WAV` is set, the array is a copy-on-write `numpy.memmap` of the
+    file's data chunk: opening the file costs next to nothing, processes
+    mapping the same file share its pages in the page cache, and anything
+    written to the array stays private to this process and never touches
+    the file.
+    """
+    w = wave.open(filename, 'r')
+    numChannels = w.getnchannels()
+    numFrames = w.getnframes()
+    sampleWidth = w.getsampwidth()
+    if not MMAP_WAV or sampleWidth != 2 or numFrames == 0:
+        raw = w.readframes(numFrames)
+        w.close()
+        data = numpy.frombuffer(raw, dtype="<h", count=numFrames * numChannels)
+        ndarray = numpy.array(data, dtype=numpy.int16)
+    else:
+        w.close()
+        offset, size = _wav_data_chunk(filename)
+        numFrames = min(numFrames, size / (2 * numChannels),
+                        (os.path.getsize(filename) - offset) / (2 * numChannels))
+        ndarray = numpy.memmap(filename, dtype="<h", mode='c', offset=offset,
+                               shape=(numFrames * numChannels,))
+    if numChannels > 1:
+        ndarray = ndarray.reshape((-1, numChannels))
+    return ndarray
+
+
+def _renders_like(renderable, cls):
+    "Whether `renderable` is a `cls` that renders the way `cls` does."
+    return isinstance(renderable, cls) and \
+           type(renderable).render.im_func is cls.render.im_func
+
+
+def _slice_length(first, last, size):
+    """
+    Returns the length of `[first:last]` of a sequence `size` long, or of
+    `size` unknown (None) as though it went on for ever.
+    """
+    if size is None:
+        return max(last - first, 0)
+    first, last, step = slice(first, last).indices(size)
+    return max(last - first, 0)
+
+
+def _fold_effects(effects, length, sampleRate):
+    """
+    Folds a chain of `effects` applied to `length` samples into a single
+    (*gain*, *length*), or returns None if any of them has no `fold`.
+    """
+    gain = 1.0
+    for effect in effects:
+        if not hasattr(effect, 'fold'):
+            return None
+        gain, length = effect.fold(gain, length, sampleRate)
+    return gain, length
+
+
+class RenderPlan(object):
+    """
+    The sample copies that make up a render, worked out before any samples
+    are touched, so that the output can be allocated once and filled in a
+    single pass over each source.
+
+    Each entry of `entries` is a tuple of (*source*, *first*, *last*,
+    *offset*, *gain*): samples *first* to *last* of the `AudioData`
+    *source*, multiplied by *gain*, are added into the output from sample
+    *offset*. Renderables that can't be broken down into copies are kept
+    in `others` as (*renderable*, *start*) and rendered the usual way.
+
+    `length` is the number of samples the entries need, `minimum` the
+    least the output may have, and `endindex` and `dtype` are those of the
+    `AudioData` made by `render`\(). `exact` is false if `length` is only
+    an estimate, because a source was not loaded yet to see where it ends.
+
+    Plans are usually made with `AudioRenderable.compile`\().
+    """
+    def __init__(self, sampleRate, numChannels, dtype=numpy.int32):
+        self.sampleRate = sampleRate
+        self.numChannels = numChannels
+        self.dtype = numpy.dtype(dtype)
+        self.entries = []
+        self.others = []
+        self.length = 0
+        self.minimum = 0
+        self.endindex = 0
+        self.exact = True
+
+    def add(self, source, first, last, offset, gain=1.0):
+        "Adds samples `first` to `last` of `source` into the output at `offset`."
+        self.entries.append((source, first, last, offset, gain))
+        if isinstance(source.data, numpy.ndarray):
+            size = len(source.data)
+        else:
+            size = None
+            self.exact = False
+        self.length = max(self.length, offset + _slice_length(first, last, size))
+
+    def add_renderable(self, renderable, start=0.0):
+        """
+        Plans the rendering of `renderable` at `start` seconds into the output,
+        as `renderable.render`\(start, to_audio, source) would for each of its
+        sources.
+        """
+        if _renders_like(renderable, AudioQuantum) and renderable.source is not None \
+           and renderable.source.sampleRate:
+            source = renderable.source
+            self.add(source, int(float(renderable.start) * source.sampleRate),
+                     int((renderable.start + renderable.duration) * source.sampleRate),
+                     int(start * self.sampleRate))
+        elif isinstance(renderable, RenderPlan):
+            self._merge(renderable, start)
+        elif _renders_like(renderable, ModifiedRenderable) and \
+             self._add_modified(renderable, start):
+            pass
+        elif _renders_like(renderable, Simultaneous):
+            for aq in list.__iter__(renderable):
+                self.add_renderable(aq, start)
+        elif _renders_like(renderable, AudioQuantumList):
+            for aq in list.__iter__(renderable):
+                self.add_renderable(aq, start)
+                start += aq.duration
+        else:
+            self.others.append((renderable, start))
+
+    def _add_modified(self, renderable, start):
+        """
+        Plans a `ModifiedRenderable` whose effects all have a `fold` method,
+        folding them into one gain and one length. Returns False if it can't.
+        """
+        original = renderable._original
+        sub = RenderPlan(self.sampleRate, self.numChannels)
+        sub.add_renderable(original)
+        if sub.others:
+            return False
+        if isinstance(original, AudioQuantumList):
+            sub.minimum = max(sub.minimum, original._render_length(self.sampleRate))
+        base_length = max(sub.length, sub.minimum)
+        folded = _fold_effects(renderable._effects, base_length, self.sampleRate)
+        if folded is None:
+            return False
+        gain, length = folded
+        if length != base_length and not sub.exact:
+            return False
+        self._merge(sub, start, gain, length)
+        return True
+
+    def _merge(self, sub, start, gain=1.0, length=None):
+        """
+        Adds the plan `sub` at `start` seconds, with its gains multiplied by
+        `gain` and, if `length` is given, its output cut or padded to `length`
+        samples.
+        """
+        offset = int(start * self.sampleRate)
+        for source, first, last, sub_offset, sub_gain in sub.entries:
+            if length is not None and isinstance(source.data, numpy.ndarray):
+                first, last, step = slice(first, last).indices(len(source.data))
+                last = min(last, first + max(length - sub_offset, 0))
+                if last <= first:
+                    continue
+            self.add(source, first, last, offset + sub_offset, sub_gain * gain)
+        for renderable, sub_start in sub.others:
+            self.others.append((renderable, start + sub_start))
+        if length is None:
+            self.length = max(self.length, offset + max(sub.length, sub.minimum))
+            self.minimum = max(self.minimum, offset + sub.minimum)
+        else:
+            self.length = max(self.length, offset + length)
+            self.minimum = max(self.minimum, offset + length)
+        self.exact = self.exact and sub.exact
+
+    def sources(self):
+        "Returns the sources used by the plan, in the order they are first used."
+        seen = set()
+        ordered = []
+        for source in [e[0] for e in self.entries] + \
+                      [s for r, start in self.others for s in r.sources()]:
+            if source not in seen:
+                seen.add(source)
+                ordered.append(source)
+        return ordered
+
+    def execute(self, to_audio, threads=None):
+        """
+        Adds everything in the plan into the `AudioData` `to_audio`, padding it
+        to fit. Returns the index of the sample after the last one written by
+        `entries`.
+
+        With more than one source, `threads` (by default RENDER_THREADS)
+        above 1 and at least RENDER_MIN_FRAMES frames to copy, the sources
+        are loaded and summed into `to_audio` by a shared pool of threads;
+        otherwise it goes one source at a time. Either way,
+        deferred sources are loaded for their turn and unloaded after it.
+        """
+        with instrument.stage('render', entries=len(self.entries), others=len(self.others)) as s:
+            end = self._execute(to_audio, threads)
+            s.moved(to_audio.data.nbytes)
+            s.array(to_audio.data)
+        return end
+
+    def _execute(self, to_audio, threads):
+        if threads is None:
+            threads = RENDER_THREADS
+        if len(to_audio.data) < self.minimum:
+            to_audio.pad_with_zeros(self.minimum - len(to_audio.data))
+        groups = {}
+        for entry in self.entries:
+            groups.setdefault(entry[0], []).append(entry)
+        if threads > 1 and len(groups) > 1 and self._frames() >= RENDER_MIN_FRAMES:
+            end = self._execute_threaded(groups, to_audio, threads)
+            sources = [source for source in self.sources() if source not in groups]
+            if not self.others:
+                return end
+        else:
+            end = 0
+            sources = self.sources()
+        for source in sources:
+            if source in groups:
+                end = max(end, self._copy(groups[source], source, to_audio))
+            for renderable, start in self.others:
+                renderable.render(start=start, to_audio=to_audio, with_source=source)
+            if source.defer:
+                source.unload()
+        return end
+
+    def _frames(self):
+        """
+        Returns the number of frames the entries copy, counting those from a
+        source that isn't loaded yet as RENDER_MIN_FRAMES, since loading it
+        is worth a thread.
+        """
+        total = 0
+        for source, first, last, offset, gain in self.entries:
+            if not isinstance(source.data, numpy.ndarray):
+                return max(total, RENDER_MIN_FRAMES)
+            total += _slice_length(first, last, len(source.data))
+        return total
+
+    def _execute_threaded(self, groups, to_audio, threads):
+        """
+        Sums `entries`, grouped by source, into `to_audio` from a pool of
+        threads, one source per task. `others` that use these sources are
+        rendered afterwards, one source at a time.
+        """
+        pool = _render_pool(threads)
+        pool.map(_load_source, groups.keys())
+        end = 0
+        for source, entries in groups.iteritems():
+            for unused, first, last, offset, gain in entries:
+                end = max(end, offset + _slice_length(first, last, len(source.data)))
+        if end > len(to_audio.data):
+            to_audio.pad_with_zeros(end - len(to_audio.data))
+        locks = [threading.Lock() for i in xrange(RENDER_LOCKS)]
+        pool.map(lambda (source, entries): self._sum(entries, source, to_audio.data, locks),
+                 groups.items())
+        for source in groups:
+            for renderable, start in self.others:
+                renderable.render(start=start, to_audio=to_audio, with_source=source)
+            if source.defer:
+                source.unload()
+        return end
+
+    def _sum(self, entries, source, out, locks):
+        "Adds `entries` from `source` into `out` a locked stripe at a time."
+        data = source.data
+        for unused, first, last, offset, gain in entries:
+            piece = data[first:last]
+            if piece.ndim < out.ndim:
+                piece = piece[:, numpy.newaxis]
+            if gain != 1:
+                piece = (piece * gain).astype(out.dtype)
+            position = 0
+            while position < len(piece):
+                stripe = (offset + position) // RENDER_STRIPE
+                stop = min(len(piece), (stripe + 1) * RENDER_STRIPE - offset)
+                with locks[stripe % len(locks)]:
+                    out[offset + position:offset + stop] += piece[position:stop]
+                position = stop
+
+    @property
+    def duration(self):
+        "The duration of the `AudioData` made by `render`\(), as in `AudioData`."
+        return float(self.endindex) / self.sampleRate
+
+    def encode(self, filename=None, mp3=None):
+        """
+        Encodes the output of the plan to `filename`, as the `AudioData` made
+        by `render`\() would be, but a block at a time: MP3 output starts
+        straight away and neither the whole output nor a temporary WAVE file
+        is ever made. Plans with `others` are rendered in full first.
+        """
+        if self.others:
+            return self.render().encode(filename, mp3)
+        filename, mp3 = _output_format(filename, mp3)
+        numFrames = self._frames()
+        if self.dtype == numpy.int16:
+            blocks = self.blocks()
+        else:
+            # Normalize as AudioData32 does, which takes a first pass for the peak.
+            peak = max([numpy.max(numpy.absolute(block)) for block in self.blocks()] or [0])
+            factor = 32767.0 / peak
+            blocks = (AudioData32._normalize(block, factor) for block in self.blocks())
+        try:
+            _encode_blocks(filename, mp3, blocks, self.sampleRate, self.numChannels,
+                           numFrames)
+        except (RuntimeError, EnvironmentError):
+            if not mp3 or self.dtype != numpy.int16:
+                raise
+            log.warning("Error converting to %s", filename)
+        return filename
+
+    def _frames(self):
+        """
+        The exact length of the output, which `length` only estimates if
+        some sources aren't loaded.
+        """
+        if self.exact:
+            return max(self.length, self.minimum)
+        end = 0
+        loaded = set()
+        for source, first, last, offset, gain in self.entries:
+            if not isinstance(source.data, numpy.ndarray) and source.defer:
+                source.load()
+                loaded.add(source)
+            end = max(end, offset + _slice_length(first, last, len(source.data)))
+        for source in loaded:
+            source.unload()
+        return max(end, self.minimum)
+
+    def blocks(self, blockSize=STREAM_BLOCK_SIZE):
+        """
+        Yields the output of the plan (which must not have `others`) in
+        blocks of `blockSize` samples of `dtype`, working out each block from
+        the entries that overlap it. Deferred sources are loaded for the
+        duration and unloaded at the end.
+        """
+        if self.others:
+            raise EchoNestRemixError("Only plans without others can be streamed.")
+        loaded = []
+        entries = []
+        for source, first, last, offset, gain in self.entries:
+            if not isinstance(source.data, numpy.ndarray) and source.defer:
+                source.load()
+                loaded.append(source)
+            first, last, step = slice(first, last).indices(len(source.data))
+            if last > first:
+                entries.append((offset, offset + last - first, source.data, first, gain))
+        entries.sort(key=lambda entry: entry[0])
+        total = max([end for offset, end, data, first, gain in entries] + [self.minimum])
+        if self.numChannels > 1:
+            tail = (self.numChannels,)
+        else:
+            tail = ()
+        try:
+            active = []
+            waiting = 0
+            for start in xrange(0, total, blockSize):
+                stop = min(start + blockSize, total)
+                block = numpy.zeros((stop - start,) + tail, dtype=self.dtype)
+                while waiting < len(entries) and entries[waiting][0] < stop:
+                    active.append(entries[waiting])
+                    waiting += 1
+                active = [entry for entry in active if entry[1] > start]
+                for offset, end, data, first, gain in active:
+                    lo = max(offset, start)
+                    hi = min(end, stop)
+                    if hi <= lo:
+                        continue
+                    piece = data[first + lo - offset:first + hi - offset]
+                    if piece.ndim < block.ndim:
+                        piece = piece[:, numpy.newaxis]
+                    if gain == 1:
+                        block[lo - start:hi - start] += piece
+                    else:
+                        block[lo - start:hi - start] += (piece * gain).astype(self.dtype)
+                yield block
+        finally:
+            for source in loaded:
+                source.unload()
+
+    def render(self):
+        "Carries out the plan, returning a new `AudioData`."
+        length = max(self.length, self.minimum)
+        if self.numChannels > 1:
+            shape = (length, self.numChannels)
+        else:
+            shape = (length,)
+        if self.dtype == numpy.int16:
+            to_audio = AudioData(shape=shape, sampleRate=self.sampleRate,
+                                 numChannels=self.numChannels, defer=False)
+        else:
+            to_audio = AudioData32(shape=shape, sampleRate=self.sampleRate,
+                                   numChannels=self.numChannels, defer=False)
+        end = self.execute(to_audio)
+        # Until they are loaded, there's no telling where deferred sources end.
+        if not self.others and len(to_audio.data) > max(self.minimum, end):
+            to_audio.data = to_audio.data[:max(self.minimum, end)]
+        to_audio.endindex = self.endindex
+        return to_audio
+
+    def _copy(self, entries, source, to_audio):
+        _load_source(source)
+        data = source.data
+        end = 0
+        for unused, first, last, offset, gain in entries:
+            piece = data[first:last]
+            stop = offset + len(piece)
+            if stop > len(to_audio.data):
+                to_audio.pad_with_zeros(stop - len(to_audio.data))
+            out = to_audio.data
+            if piece.ndim < out.ndim:
+                piece = piece[:, numpy.newaxis]
+            if gain == 1:
+                out[offset:stop] += piece
             else:
-                extra_shape = (num_samples, self.numChannels)
-            self.data = numpy.append(self.data,
-                                     numpy.zeros(extra_shape, dtype=numpy.int32), axis=0)
+                out[offset:stop] += (piece * gain).astype(out.dtype)
+            end = max(end, stop)
+        return end
+
+
+_pool = None
+_pool_key = None
+_pool_lock = threading.Lock()
+
+def _render_pool(threads):
+    """
+    Returns the pool of `threads` threads that `RenderPlan` renders with,
+    made the first time it is needed and again after a fork, whose child
+    doesn't get the parent's threads.
+    """
+    global _pool, _pool_key
+    with _pool_lock:
+        if _pool_key != (os.getpid(), threads):
+            if _pool is not None and _pool_key[0] == os.getpid():
+                _pool.close()
+            _pool = ThreadPool(threads)
+            _pool_key = (os.getpid(), threads)
+        return _pool
+
+
+def _load_source(source):
+    if not isinstance(source.data, numpy.ndarray) and source.defer:
+        source.load()
 
-def getpieces(audioData, segs):
+
+def getpieces(audioData, segs, lazy=False):
     """
     Collects audio samples for output.
     Returns a new `AudioData` where the new sample data is assembled
     from the input audioData according to the time offsets in each
     of the elements of the input segs (commonly an `AudioQuantumList`).
 
+    The pieces are gathered straight from `audioData` with a single
+    concatenation of views, so the only copy made is the output itself.
+
     :param audioData: an `AudioData` object
     :param segs: an iterable containing objects that may be accessed
         as slices or indices for an `AudioData`
+    :param lazy: if true, return a `RenderPlan` of the result instead,
+        leaving the samples where they are until it is rendered (a deferred
+        `audioData` is still loaded, to find where it ends, and unloaded
+        again once the plan is rendered)
     """
-
+    start = time.time()
     # Ensure that we have data
-    if not audioData.data.all() or audioData.defer:
-        audioData.data = None
+    if not isinstance(audioData.data, numpy.ndarray):
         audioData.load()
+    sampleRate = audioData.sampleRate
+    data = audioData.data
+    newchans = data.shape[1] if data.ndim > 1 else 1
 
-    dur = 0
-    for s in segs:
-        dur += int(s.duration * audioData.sampleRate)
+    if isinstance(segs, AudioQuantumList):
+        starts = numpy.asarray(segs.start, dtype=numpy.float64)
+        durations = numpy.asarray(segs.durations, dtype=numpy.float64)
+    else:
+        segs = list(segs)
+        starts = numpy.array([float(s.start) for s in segs], dtype=numpy.float64)
+        durations = numpy.array([s.duration for s in segs], dtype=numpy.float64)
+    firsts = (starts * sampleRate).astype(numpy.int64).tolist()
+    lasts = ((starts + durations) * sampleRate).astype(numpy.int64).tolist()
+    dur = int(numpy.sum((durations * sampleRate).astype(numpy.int64)))
     # if I wanted to add some padding to the length, I'd do it here
 
-    #determine shape of new array
-    if len(audioData.data.shape) > 1:
-        newshape = (dur, audioData.data.shape[1])
-        newchans = audioData.data.shape[1]
+    if lazy:
+        plan = RenderPlan(sampleRate, newchans, dtype=numpy.int16)
+        size = len(data)
+        offset = 0
+        for first, last in zip(firsts, lasts):
+            plan.add(audioData, first, last, offset)
+            offset += _slice_length(first, last, size)
+        plan.minimum = dur
+        plan.endindex = offset
+        return plan
+
+    pieces = [data[first:last] for first, last in zip(firsts, lasts)]
+    endindex = sum(len(piece) for piece in pieces)
+    if endindex < dur:
+        pieces.append(numpy.zeros((dur - endindex,) + data.shape[1:], dtype=numpy.int16))
+    if pieces:
+        newdata = numpy.concatenate(pieces)
     else:
-        newshape = (dur,)
-        newchans = 1
-
-    #make accumulator segment
-    newAD = AudioData(shape=newshape, sampleRate=audioData.sampleRate,
-                    numChannels=newchans, defer=False, verbose=audioData.verbose)
-
-    #concatenate segs to the new segment
-    for s in segs:
-        newAD.append(audioData[s])
-    # audioData.unload()
+        newdata = numpy.zeros((0,) + data.shape[1:], dtype=numpy.int16)
+
+    newAD = AudioData(sampleRate=sampleRate, numChannels=newchans, defer=False,
+                      verbose=audioData.verbose)
+    newAD.data = newdata.astype(numpy.int16, copy=False)
+    newAD.endindex = endindex
+    instrument.record('render', start, bytes=newAD.data.nbytes, peak=newAD.data.nbytes,
+                      pieces=len(firsts))
     return newAD
 
 
@@ -776,6 +1416,97 @@ def assemble(audioDataList, numChannels=1, sampleRate=44100, verbose=True):
                         sampleRate=sampleRate, defer=False, verbose=verbose)
 
 
+# Soft-knee limiter applied by `MixBus`, matching cAction's `limit`.
+LIMIT_THRESHOLD = 30000.0
+LIMIT_RANGE = 32767.0 - LIMIT_THRESHOLD
+
+
+def _soft_limit(block):
+    """
+    Limits a float32 block in place: samples beyond LIMIT_THRESHOLD are
+    squashed by an arctangent knee so they never exceed 16-bit range.
+    Uses cAction when it has been built.
+    """
+    if _limit is not None and block.flags.c_contiguous:
+        _limit(block if block.ndim == 2 else block.reshape(-1, 1))
+        return block
+    over = numpy.abs(block) > LIMIT_THRESHOLD
+    if over.any():
+        peaks = block[over]
+        knee = numpy.arctan((numpy.abs(peaks) - LIMIT_THRESHOLD) / LIMIT_RANGE)
+        knee *= LIMIT_RANGE / (numpy.pi / 2)
+        knee += LIMIT_THRESHOLD
+        block[over] = numpy.copysign(knee, peaks)
+    return block
+
+
+class MixBus(object):
+    """
+    A float32 accumulator for mixing `AudioData` objects.
+
+    Inputs are scaled by their gain and summed into the bus a block at a
+    time, so nothing is truncated or wraps around until `render` limits
+    the total once and converts it to 16-bit samples::
+
+        bus = MixBus(len(drums), drums.numChannels, drums.sampleRate)
+        bus.add(drums, 0.7)
+        bus.add(vocals, 0.3, offset=44100)
+        out = bus.render()
+    """
+    def __init__(self, numFrames, numChannels=2, sampleRate=44100):
+        self.sampleRate = sampleRate
+        self.numChannels = numChannels
+        if numChannels == 1:
+            self.data = numpy.zeros(numFrames, dtype=numpy.float32)
+        else:
+            self.data = numpy.zeros((numFrames, numChannels), dtype=numpy.float32)
+
+    def __len__(self):
+        return len(self.data)
+
+    def add(self, audioData, gain=1.0, offset=0):
+        """
+        Adds `audioData` (an `AudioData` or sample array) scaled by `gain`,
+        starting `offset` frames into the bus. Anything past the end of
+        the bus is dropped; mono input is spread across every channel.
+        """
+        if isinstance(audioData, AudioData):
+            if not isinstance(audioData.data, numpy.ndarray):
+                audioData.load()
+            samples = audioData.data[:audioData.endindex]
+        else:
+            samples = audioData
+        if self.data.ndim == 2 and samples.ndim == 1:
+            samples = samples[:, numpy.newaxis]
+        elif self.data.ndim == 1 and samples.ndim == 2:
+            samples = samples.mean(axis=1)
+        samples = samples[:max(0, len(self.data) - offset)]
+        gain = numpy.float32(gain)
+        scratch = numpy.empty((STREAM_BLOCK_SIZE,) + self.data.shape[1:], dtype=numpy.float32)
+        for start in xrange(0, len(samples), STREAM_BLOCK_SIZE):
+            block = samples[start:start + STREAM_BLOCK_SIZE]
+            temp = scratch[:len(block)]
+            numpy.multiply(block, gain, out=temp, casting='unsafe')
+            self.data[offset + start:offset + start + len(block)] += temp
+        return self
+
+    def render(self, verbose=True):
+        """
+        Returns the limited mix as a new 16-bit `AudioData`.
+        """
+        out = AudioData(shape=self.data.shape, sampleRate=self.sampleRate,
+                        numChannels=self.numChannels, defer=False, verbose=verbose)
+        scratch = numpy.empty((STREAM_BLOCK_SIZE,) + self.data.shape[1:], dtype=numpy.float32)
+        for start in xrange(0, len(self.data), STREAM_BLOCK_SIZE):
+            block = self.data[start:start + STREAM_BLOCK_SIZE]
+            temp = scratch[:len(block)]
+            temp[:] = block
+            numpy.rint(_soft_limit(temp), out=temp)
+            out.data[start:start + len(block)] = temp
+        out.endindex = len(out.data)
+        return out
+
+
 def mix(dataA, dataB, mix=0.5):
     """
     Mixes two `AudioData` objects. Assumes they have the same sample rate
@@ -784,15 +1515,11 @@ def mix(dataA, dataB, mix=0.5):
     Mix takes a float 0-1 and determines the relative mix of two audios.
     i.e., mix=0.9 yields greater presence of dataA in the final mix.
     """
-    if dataA.endindex > dataB.endindex:
-        newdata = AudioData(ndarray=dataA.data, sampleRate=dataA.sampleRate, numChannels=dataA.numChannels, defer=False)
-        newdata.data *= float(mix)
-        newdata.data[:dataB.endindex] += dataB.data[:] * (1 - float(mix))
-    else:
-        newdata = AudioData(ndarray=dataB.data, sampleRate=dataB.sampleRate, numChannels=dataB.numChannels, defer=False)
-        newdata.data *= 1 - float(mix)
-        newdata.data[:dataA.endindex] += dataA.data[:] * float(mix)
-    return newdata
+    longer = dataA if dataA.endindex > dataB.endindex else dataB
+    bus = MixBus(len(longer.data), longer.numChannels, longer.sampleRate)
+    bus.add(dataA, float(mix))
+    bus.add(dataB, 1 - float(mix))
+    return bus.render()
 
 
 def normalize(audio):
@@ -840,14 +1567,10 @@ def truncatemix(dataA, dataB, mix=0.5):
     If dataB is longer than dataA, dataB is truncated to dataA's length.
     Note that if dataA is longer than dataB, dataA will not be truncated.
     """
-    newdata = AudioData(ndarray=dataA.data, sampleRate=dataA.sampleRate,
-                        numChannels=dataA.numChannels, verbose=False)
-    newdata.data *= float(mix)
-    if dataB.endindex > dataA.endindex:
-        newdata.data[:] += dataB.data[:dataA.endindex] * (1 - float(mix))
-    else:
-        newdata.data[:dataB.endindex] += dataB.data[:] * (1 - float(mix))
-    return newdata
+    bus = MixBus(len(dataA.data), dataA.numChannels, dataA.sampleRate)
+    bus.add(dataA, float(mix))
+    bus.add(dataB, 1 - float(mix))
+    return bus.render(verbose=False)
 
 
 def megamix(dataList):
@@ -858,24 +1581,15 @@ def megamix(dataList):
     """
     if not isinstance(dataList, list):
         raise TypeError('input must be a list of AudioData objects')
-    newdata = AudioData(shape=dataList[0].data.shape, sampleRate=dataList[0].sampleRate,
-                            numChannels=dataList[0].numChannels, defer=False)
     for adata in dataList:
         if not isinstance(adata, AudioData):
             raise TypeError('input must be a list of AudioData objects')
-        if len(adata) > len(newdata):
-            newseg = AudioData(ndarray=adata[:newdata.endindex].data,
-                                numChannels=newdata.numChannels,
-                                sampleRate=newdata.sampleRate, defer=False)
-            newseg.endindex = newdata.endindex
-        else:
-            newseg = AudioData(ndarray=adata.data,
-                                numChannels=newdata.numChannels,
-                                sampleRate=newdata.sampleRate, defer=False)
-            newseg.endindex = adata.endindex
-        newdata.data[:newseg.endindex] += (newseg.data / float(len(dataList))).astype(newdata.data.dtype)
-    newdata.endindex = len(newdata)
-    return newdata
+    first = dataList[0]
+    bus = MixBus(len(first.data), first.numChannels, first.sampleRate)
+    gain = 1.0 / len(dataList)
+    for adata in dataList:
+        bus.add(adata, gain)
+    return bus.render()
 
 
 class LocalAudioFile(AudioData):
@@ -894,8 +1608,10 @@ class LocalAudioFile(AudioData):
 
         # Make sure we have a local database
         check_and_create_local_db()
-        track_md5 = hashlib.md5(file(filename, 'rb').read()).hexdigest()
-        if check_db(track_md5):
+        track_md5 = file_md5(filename)
+        audio_cached = has_audio(track_md5)
+        source_filename = filename
+        if audio_cached:
             log.info("Loading audio from local db")
             filename = get_audio_file(track_md5)
             numChannels = 2
@@ -906,26 +1622,31 @@ class LocalAudioFile(AudioData):
         if verbose:
             log.info("Computed MD5 of file is %s", track_md5)
 
-        if check_db(track_md5):
-            log.info("Loading analysis from local db")
-            track_file = get_analysis_file(track_md5)
-            tempanalysis = AudioAnalysis(track_file, fromLocal=True)
-        else:
-            try:
-                if verbose:
-                    log.info("Probing for existing analysis")
-                tempanalysis = AudioAnalysis(track_md5)
-            except Exception:
-                if verbose:
-                    log.info("Analysis not found. Uploading...")
-                tempanalysis = AudioAnalysis(filename)
+        analysis_cached = has_analysis(track_md5)
+        with instrument.stage('analysis', md5=track_md5, cached=analysis_cached) as s:
+            if analysis_cached:
+                log.info("Loading analysis from local db")
+                track_file = get_analysis_file(track_md5)
+                s.moved(os.path.getsize(track_file))
+                tempanalysis = AudioAnalysis(track_file, fromLocal=True)
+            else:
+                try:
+                    if verbose:
+                        log.info("Probing for existing analysis")
+                    tempanalysis = AudioAnalysis(track_md5)
+                except Exception:
+                    if verbose:
+                        log.info("Analysis not found. Uploading...")
+                    tempanalysis = AudioAnalysis(source_filename)
 
         self.analysis = tempanalysis
         self.analysis.source = self
 
-        if not check_db(track_md5):
+        if not (audio_cached and analysis_cached):
             log.info("Saving track to local db")
-            save_to_local(track_md5, self.convertedfile, self.analysis.pyechonest_track)
+            save_to_local(track_md5,
+                          None if audio_cached else self.convertedfile,
+                          None if analysis_cached else self.analysis.pyechonest_track)
 
 
     def toxml(self, context=None):
@@ -958,20 +1679,137 @@ class LocalAnalysis(object):
         :param filename: path to a local MP3 file
         """
 
-        track_md5 = hashlib.md5(file(filename, 'rb').read()).hexdigest()
+        check_and_create_local_db()
+        track_md5 = file_md5(filename)
         if verbose:
             log.info("Computed MD5 of file is %s", track_md5)
-        try:
-            if verbose:
-                log.info("Probing for existing analysis")
-            tempanalysis = AudioAnalysis(track_md5)
-        except Exception:
-            if verbose:
-                log.info("Analysis not found. Uploading...")
-            tempanalysis = AudioAnalysis(filename)
+        with instrument.stage('analysis', md5=track_md5, cached=False):
+            try:
+                if verbose:
+                    log.info("Probing for existing analysis")
+                tempanalysis = AudioAnalysis(track_md5)
+            except Exception:
+                if verbose:
+                    log.info("Analysis not found. Uploading...")
+                tempanalysis = AudioAnalysis(filename)
         self.analysis = tempanalysis
         self.analysis.source = self
 
+# Attributes of an AudioQuantum that an AudioQuantumList returns as arrays.
+_COLUMN_ATTRIBUTES = frozenset(['start', 'duration', 'confidence', 'pitches', 'timbre',
+                                'loudness_begin', 'loudness_max', 'time_loudness_max',
+                                'loudness_end'])
+
+# Section-only attributes, in the order AudioQuantum.__init__ takes them.
+_SECTION_ATTRIBUTES = ('key', 'key_confidence', 'mode', 'mode_confidence', 'tempo',
+                       'tempo_confidence', 'loudness', 'time_signature',
+                       'time_signature_confidence')
+
+def _vector(values):
+    """
+    Stores a pitch or timbre vector as a float32 array instead of a list of
+    floats, so list methods such as `index` don't apply to it. Rows of an
+    analysis column are already float32 views and are kept as is.
+    """
+    if values is None:
+        return []
+    return numpy.asarray(values, dtype=numpy.float32)
+
+def _attack_offset(starts, marker_starts):
+    """
+    The mean time from each of `marker_starts` to the segment `starts` that
+    come within FUSION_INTERVAL after it. Each segment is only compared to
+    the first marker that starts less than FUSION_INTERVAL before it.
+    """
+    following = numpy.searchsorted(marker_starts + FUSION_INTERVAL, starts, 'right')
+    compared = following < len(marker_starts)
+    offsets = numpy.abs(marker_starts[following[compared]] - starts[compared])
+    offsets = offsets[offsets < FUSION_INTERVAL]
+    if not len(offsets):
+        return AVG_PEAK_OFFSET
+    return numpy.average(offsets)
+
+def _resample(starts, durations, values, marker_starts, marker_durations):
+    """
+    Averages `values` (a row per segment) over each marker, weighting each
+    segment by its overlap with the marker. The overlaps come from the
+    integral of the segment values over time, so each marker is just the
+    difference between the integral at its end and at its start.
+    """
+    rates = values.reshape((len(values), -1))
+    integral = numpy.zeros((len(values) + 1, rates.shape[1]))
+    numpy.cumsum(rates * durations[:, numpy.newaxis], axis=0, out=integral[1:])
+
+    def integrate(times):
+        containing = numpy.searchsorted(starts, times, 'right') - 1
+        before = numpy.maximum(containing, 0)
+        elapsed = numpy.clip(times - starts[before], 0, durations[before])
+        total = integral[before] + elapsed[:, numpy.newaxis] * rates[before]
+        total[containing < 0] = 0
+        return total
+
+    averages = integrate(marker_starts + marker_durations) - integrate(marker_starts)
+    averages /= marker_durations[:, numpy.newaxis]
+    return averages.reshape((len(marker_starts),) + values.shape[1:]).astype(numpy.float32)
+
+def _is_at(group, position, quantum):
+    "Whether `quantum` is at `position` in the list `group`."
+    return position is not None and 0 <= position < len(group) and \
+           list.__getitem__(group, position) is quantum
+
+class _QuantumIndex(object):
+    """
+    Start and end times of a list of quanta, for finding the ones that
+    overlap a span by binary search instead of a scan of the whole list.
+    """
+    def __init__(self, quanta):
+        self.quanta = quanta
+        self.version = getattr(quanta, '_version', None)
+        self.items = list(quanta)
+        if isinstance(quanta, AudioQuantumList):
+            self.starts = quanta.start
+            self.ends = quanta.start + quanta.durations
+        else:
+            self.starts = numpy.array([q.start for q in self.items])
+            self.ends = numpy.array([q.end for q in self.items])
+        # Lists out of time order are searched the slow way.
+        self.ordered = bool(numpy.all(numpy.diff(self.starts) >= 0) and
+                            numpy.all(numpy.diff(self.ends) >= 0))
+
+    def is_current(self, quanta):
+        return quanta is self.quanta and self.version is not None and \
+               self.version == quanta._version
+
+    def overlapping(self, start, end):
+        """
+        Returns, in list order, the quanta that may overlap `start` to `end`:
+        exactly those that do if the list is in time order, and all of
+        them otherwise.
+        """
+        if not self.ordered:
+            return self.items
+        first = self.ends.searchsorted(start, 'right')
+        last = self.starts.searchsorted(end, 'left')
+        return self.items[first:last]
+
+    def within(self, start, end):
+        """
+        Returns, in list order, the quanta that may lie inside `start` to
+        `end`: exactly those that do if the list is in time order, and all
+        of them otherwise.
+        """
+        if not self.ordered:
+            return self.items
+        first = self.starts.searchsorted(start, 'left')
+        last = self.ends.searchsorted(end, 'right')
+        return self.items[first:last]
+
+def _quantum_index(analysis, kind):
+    "Returns the cached index of `analysis` if it keeps one, or a new index."
+    if isinstance(analysis, AudioAnalysis):
+        return analysis._index(kind)
+    return _QuantumIndex(getattr(analysis, kind))
+
 class AudioQuantum(AudioRenderable):
     """
     A unit of musical time, identified at minimum with a start time and
@@ -988,6 +1826,13 @@ class AudioQuantum(AudioRenderable):
         created upon creation of the `AudioQuantumList` that covers
         the whole track
     """
+    # Quanta are created by the thousand for every analysis, so they keep
+    # their attributes in slots rather than a per-instance dict. The
+    # section-only fields share a single slot that stays None for beats,
+    # bars and tatums.
+    __slots__ = ('start', 'duration', 'kind', 'confidence', '_source',
+                 '_section', 'container', '_position')
+
     def __init__(self, start=0, duration=0, kind=None, confidence=None, source=None,
                 key=None, key_confidence=None, mode=None, mode_confidence=None,
                 tempo=None, tempo_confidence=None, loudness=None,
@@ -1007,15 +1852,44 @@ class AudioQuantum(AudioRenderable):
         self._source = source
 
         # These params are only for sections, for now.
-        self.key = key
-        self.key_confidence = key_confidence
-        self.mode = mode
-        self.mode_confidence = mode_confidence
-        self.tempo = tempo
-        self.tempo_confidence = tempo_confidence
-        self.loudness = loudness
-        self.time_signature = time_signature
-        self.time_signature_confidence = time_signature_confidence
+        section = (key, key_confidence, mode, mode_confidence, tempo,
+                   tempo_confidence, loudness, time_signature,
+                   time_signature_confidence)
+        if any(value is not None for value in section):
+            self._section = dict(zip(_SECTION_ATTRIBUTES, section))
+        else:
+            self._section = None
+
+    def __setattr__(self, name, value):
+        # Keep the container's cached arrays of these attributes up to date.
+        if name in _COLUMN_ATTRIBUTES:
+            container = getattr(self, 'container', None)
+            if isinstance(container, AudioQuantumList):
+                container._invalidate()
+        object.__setattr__(self, name, value)
+
+    def _section_attribute(name):
+        def get(self):
+            section = self._section
+            if section is None:
+                return None
+            return section.get(name)
+        def set(self, value):
+            if self._section is None:
+                self._section = {}
+            self._section[name] = value
+        return property(get, set)
+
+    key = _section_attribute('key')
+    key_confidence = _section_attribute('key_confidence')
+    mode = _section_attribute('mode')
+    mode_confidence = _section_attribute('mode_confidence')
+    tempo = _section_attribute('tempo')
+    tempo_confidence = _section_attribute('tempo_confidence')
+    loudness = _section_attribute('loudness')
+    time_signature = _section_attribute('time_signature')
+    time_signature_confidence = _section_attribute('time_signature_confidence')
+    del _section_attribute
 
     def get_end(self):
         return self.start + self.duration
@@ -1057,8 +1931,8 @@ class AudioQuantum(AudioRenderable):
                        'beat':  'bars',
                        'bar':   'sections'}
         try:
-            all_chunks = getattr(self.container.container, parent_dict[self.kind])
-            for chunk in all_chunks:
+            index = _quantum_index(self.container.container, parent_dict[self.kind])
+            for chunk in index.overlapping(self.start, self.end):
                 if self.start < chunk.end and self.end > chunk.start:
                     return chunk
             return None
@@ -1076,9 +1950,9 @@ class AudioQuantum(AudioRenderable):
                          'bar':     'beats',
                          'section': 'bars'}
         try:
-            all_chunks = getattr(self.container.container, children_dict[self.kind])
+            index = _quantum_index(self.container.container, children_dict[self.kind])
             child_chunks = AudioQuantumList(kind=children_dict[self.kind])
-            for chunk in all_chunks:
+            for chunk in index.within(self.start, self.end):
                 if chunk.start >= self.start and chunk.end <= self.end: 
                     child_chunks.append(chunk)
                     continue
@@ -1097,11 +1971,11 @@ class AudioQuantum(AudioRenderable):
         if self.kind == 'segment':
             return [self]
 
-        all_segments = self.source.analysis.segments
+        index = _quantum_index(self.source.analysis, 'segments')
         filtered_segments = AudioQuantumList(kind="segment")
         
         # Filter and then break once we've got the needed segments
-        for segment in all_segments:
+        for segment in index.overlapping(self.start, self.end):
             if segment.start < self.end and segment.end > self.start:
                 filtered_segments.append(segment)
             elif len(filtered_segments) != 0:
@@ -1159,6 +2033,22 @@ class AudioQuantum(AudioRenderable):
         else:
             return self.container
 
+    def _container_index(self):
+        """
+        Returns the position of the `AudioQuantum` in its container, as
+        recorded by `AudioQuantumList.attach`\(), recording the positions
+        again if the container has changed since.
+        """
+        group = self.container
+        position = getattr(self, '_position', None)
+        if _is_at(group, position, self):
+            return position
+        if isinstance(group, AudioQuantumList) and group._reindex():
+            position = getattr(self, '_position', None)
+            if _is_at(group, position, self):
+                return position
+        return group.index(self)
+
     def prev(self, step=1):
         """
         Step backwards in the containing `AudioQuantumList`.
@@ -1166,7 +2056,7 @@ class AudioQuantum(AudioRenderable):
         """
         group = self.container
         try:
-            loc = group.index(self)
+            loc = self._container_index()
             new = max(loc - step, 0)
             return group[new]
         except Exception:
@@ -1179,7 +2069,7 @@ class AudioQuantum(AudioRenderable):
         """
         group = self.container
         try:
-            loc = group.index(self)
+            loc = self._container_index()
             new = min(loc + step, len(group))
             return group[new]
         except Exception:
@@ -1229,7 +2119,7 @@ class AudioQuantum(AudioRenderable):
         """
         group = self.container
         count = len(group)
-        loc = group.index(self)
+        loc = self._container_index()
         return (loc, count,)
 
     def context_string(self):
@@ -1251,10 +2141,22 @@ class AudioQuantum(AudioRenderable):
         """
         Eliminates the circular reference for pickling.
         """
-        dictclone = self.__dict__.copy()
-        if 'container' in dictclone:
-            del dictclone['container']
-        return dictclone
+        state = {}
+        for cls in type(self).__mro__:
+            for name in cls.__dict__.get('__slots__', ()):
+                if name not in ('container', '_position') and hasattr(self, name):
+                    state[name] = getattr(self, name)
+        return state
+
+    def __setstate__(self, state):
+        """
+        Restores the slots, including from pickles made before quanta
+        used them.
+        """
+        if '_section' not in state:
+            self._section = None
+        for name, value in state.iteritems():
+            setattr(self, name, value)
 
     def toxml(self, context=None):
         attributedict = {'duration': str(self.duration),
@@ -1285,6 +2187,9 @@ class AudioSegment(AudioQuantum):
     Subclass of `AudioQuantum` for the data-rich segments returned by
     the Analyze API.
     """
+    __slots__ = ('pitches', 'timbre', 'loudness_begin', 'loudness_max',
+                 'time_loudness_max', 'loudness_end')
+
     def __init__(self, start=0., duration=0., pitches = None, timbre = None,
                  loudness_begin=0., loudness_max=0., time_loudness_max=0.,
                  loudness_end=None, kind='segment', source=None):
@@ -1293,10 +2198,10 @@ class AudioSegment(AudioQuantum):
 
         :param start: offset from start of the track, in seconds
         :param duration: duration of the `AudioSegment`, in seconds
-        :param pitches: a twelve-element list with relative loudnesses of each
-                pitch class, from C (pitches[0]) to B (pitches[11])
-        :param timbre: a twelve-element list with the loudness of each of a
-                principal component of time and/or frequency profile
+        :param pitches: twelve relative loudnesses of each pitch class,
+                from C (pitches[0]) to B (pitches[11])
+        :param timbre: twelve loudnesses of each of a principal component
+                of time and/or frequency profile
         :param kind: string identifying the kind of AudioQuantum: "segment"
         :param loudness_begin: loudness in dB at the start of the segment
         :param loudness_max: loudness in dB at the loudest moment of the
@@ -1304,11 +2209,16 @@ class AudioSegment(AudioQuantum):
         :param time_loudness_max: time (in sec from start of segment) of
                 loudest moment
         :param loudness_end: loudness at end of segment (if it is given)
+
+        `pitches` and `timbre` are stored as float32 numpy arrays, not
+        lists: use e.g. `int(numpy.argmax(segment.pitches))` rather than
+        `pitches.index(max(pitches))`, and `list(segment.pitches)` where a
+        list is needed.
         """
         self.start = start
         self.duration = duration
-        self.pitches = pitches or []
-        self.timbre = timbre or []
+        self.pitches = _vector(pitches)
+        self.timbre = _vector(timbre)
         self.loudness_begin = loudness_begin
         self.loudness_max = loudness_max
         self.time_loudness_max = time_loudness_max
@@ -1317,7 +2227,8 @@ class AudioSegment(AudioQuantum):
         self.kind = kind
         self.confidence = None
         self._source = source
-        
+        self._section = None
+
 
     @property
     def tatum(self):
@@ -1326,9 +2237,9 @@ class AudioSegment(AudioQuantum):
         Note that some segments have NO overlapping tatums.
         If this is the case, None will be returned.
         """
-        all_tatums = self.source.analysis.tatums
+        index = _quantum_index(self.source.analysis, 'tatums')
         filtered_tatums = []
-        for tatum in all_tatums:
+        for tatum in index.overlapping(self.start, self.end):
             # If the segment contains the tatum
             if self.start < tatum.start and self.end > tatum.end:
                 filtered_tatums.append((tatum, tatum.duration))
@@ -1389,19 +2300,43 @@ class ModifiedRenderable(AudioRenderable):
     def render(self, start=0.0, to_audio=None, with_source=None):
         if not to_audio:
             base = self._original.render(with_source=with_source)
-            copy = AudioData32(ndarray=base.data, sampleRate=base.sampleRate, numChannels=base.numChannels, defer=False)
-            for effect in self._effects:
-                copy = effect.modify(copy)
-            return copy
+            return self._modify(base)
         if with_source != self.source:
             return
         base = self._original.render(with_source=with_source)
-        copy = AudioData32(ndarray=base.data, shape=base.data.shape, sampleRate=base.sampleRate, numChannels=base.numChannels, defer=False)
-        for effect in self._effects:
-            copy = effect.modify(copy)
-        to_audio.add_at(start, copy)
+        to_audio.add_at(start, self._modify(base))
         return
 
+    def _modify(self, base):
+        """
+        Applies the effects to the rendered `base`. If they can all be folded
+        into one gain and one length, that takes a single pass over just the
+        samples that survive; otherwise each effect modifies a copy in turn.
+        Either way the result is an `AudioData32`, or an `AudioData` if an
+        effect changed the length, as the effects' `modify`\() returns.
+        """
+        folded = _fold_effects(self._effects, len(base.data), base.sampleRate)
+        if folded is None:
+            copy = AudioData32(ndarray=base.data, sampleRate=base.sampleRate, numChannels=base.numChannels, defer=False)
+            for effect in self._effects:
+                copy = effect.modify(copy)
+            return copy
+        gain, length = folded
+        data = numpy.zeros((length,) + base.data.shape[1:], dtype=numpy.int32)
+        kept = min(length, len(base.data))
+        if gain == 1:
+            data[:kept] = base.data[:kept]
+        else:
+            numpy.multiply(base.data[:kept], gain, out=data[:kept], casting='unsafe')
+        copy = AudioData32(sampleRate=base.sampleRate, numChannels=base.numChannels, defer=False)
+        copy.data = data
+        copy.endindex = length
+        if any(hasattr(effect, 'duration') for effect in self._effects):
+            # Effects that change the length return a slice, which is a
+            # 16-bit `AudioData`, so the folded result is one too.
+            return copy[:length]
+        return copy
+
     def toxml(self, context=None):
         outerattributedict = {'duration': str(self.duration)}
         node = etree.Element("modified_audioquantum", attrib=outerattributedict)
@@ -1428,6 +2363,16 @@ class ModifiedRenderable(AudioRenderable):
 
 
 class AudioEffect(object):
+    """
+    Base class for effects, which wrap an `AudioRenderable` in a
+    `ModifiedRenderable` that applies `modify`\() to its rendered audio.
+
+    An effect that only scales the samples and/or cuts or pads the audio to
+    a new length can also provide `fold`\(gain, length, sampleRate), which
+    returns the gain and length (in samples) after the effect given those
+    before it. Chains of such effects are planned by `RenderPlan` without
+    calling `modify`\() at all.
+    """
     def __call__(self, aq):
         return ModifiedRenderable(aq, [self])
 
@@ -1436,6 +2381,9 @@ class LevelDB(AudioEffect):
     def __init__(self, change):
         self.change = change
 
+    def fold(self, gain, length, sampleRate):
+        return gain * pow(10., self.change / 20.), length
+
     def modify(self, adata):
         adata.data *= pow(10., self.change / 20.)
         return adata
@@ -1445,6 +2393,9 @@ class AmplitudeFactor(AudioEffect):
     def __init__(self, change):
         self.change = change
 
+    def fold(self, gain, length, sampleRate):
+        return gain * self.change, length
+
     def modify(self, adata):
         adata.data *= self.change
         return adata
@@ -1457,6 +2408,9 @@ class TimeTruncateFactor(AudioEffect):
     def duration(self, old_duration):
         return old_duration * self.factor
 
+    def fold(self, gain, length, sampleRate):
+        return gain, int(self.factor * length)
+
     def modify(self, adata):
         endindex = int(self.factor * len(adata))
         if self.factor > 1:
@@ -1472,6 +2426,9 @@ class TimeTruncateLength(AudioEffect):
     def duration(self, old_duration):
         return self.new_duration
 
+    def fold(self, gain, length, sampleRate):
+        return gain, int(self.new_duration * sampleRate)
+
     def modify(self, adata):
         endindex = int(self.new_duration * adata.sampleRate)
         if self.new_duration > adata.duration:
@@ -1498,7 +2455,17 @@ class AudioQuantumList(list, AudioRenderable):
     If `AudioQuantumList.kind` is "`segment`", then `pitches`, `timbre`,
     `loudness_begin`, `loudness_max`, `time_loudness_max`, and `loudness_end`
     are available.
+
+    These accessors return read-only `numpy.array`\s. For the lists of an
+    `AudioAnalysis` (and any other list its quanta are attached to) they are
+    computed once, or taken straight from the parsed analysis, and cached
+    until the list or one of its quanta changes.
     """
+    _columns = None
+    _attached = False
+    _version = 0
+    _indexed_version = None
+
     def __init__(self, initial = None, kind = None, container = None, source = None):
         """
         Initializes an `AudioQuantumList`. All parameters are optional.
@@ -1526,27 +2493,72 @@ class AudioQuantumList(list, AudioRenderable):
         if initial:
             self.extend(initial)
 
+    def _column(self, attribute):
+        """
+        Returns an array of `attribute` for each `AudioQuantum`, cached if this
+        list is the container of its quanta.
+        """
+        columns = self._columns
+        if columns is not None and attribute in columns:
+            return columns[attribute]
+        column = _read_only(numpy.array([getattr(x, attribute) for x in list.__iter__(self)]))
+        if self._attached:
+            if columns is None:
+                columns = self._columns = {}
+            columns[attribute] = column
+        return column
+
+    def _invalidate(self):
+        "Drops anything cached about the contents of the list."
+        self._columns = None
+        self._version += 1
+
+    def _invalidating(method):
+        def fun(self, *args, **kwargs):
+            self._invalidate()
+            return method(self, *args, **kwargs)
+        fun.__name__ = method.__name__
+        fun.__doc__ = method.__doc__
+        return fun
+
+    append      = _invalidating(list.append)
+    extend      = _invalidating(list.extend)
+    insert      = _invalidating(list.insert)
+    pop         = _invalidating(list.pop)
+    remove      = _invalidating(list.remove)
+    reverse     = _invalidating(list.reverse)
+    sort        = _invalidating(list.sort)
+    __setitem__ = _invalidating(list.__setitem__)
+    __delitem__ = _invalidating(list.__delitem__)
+    __setslice__ = _invalidating(list.__setslice__)
+    __delslice__ = _invalidating(list.__delslice__)
+    __iadd__    = _invalidating(list.__iadd__)
+    __imul__    = _invalidating(list.__imul__)
+
     def get_many(attribute):
         def fun(self):
             """
-            Returns a list of %s for each `AudioQuantum`.
+            Returns an array of %s for each `AudioQuantum`.
             """ % attribute
-            return [getattr(x, attribute) for x in list.__iter__(self)]
+            return self._column(attribute)
         return fun
 
     def get_many_if_segment(attribute):
         def fun(self):
             """
-            Returns a list of %s for each `Segment`.
+            Returns an array of %s for each `Segment`.
             """ % attribute
             if self.kind == 'segment':
-                return [getattr(x, attribute) for x in list.__iter__(self)]
+                return self._column(attribute)
             else:
                 raise AttributeError("<%s> only accessible for segments" % (attribute,))
         return fun
 
+    def get_kinds(self):
+        return [x.kind for x in list.__iter__(self)]
+
     def get_duration(self):
-        return sum(self.durations)
+        return float(numpy.sum(self.durations))
 
     def get_source(self):
         "Returns its own or its parent's source."
@@ -1569,7 +2581,7 @@ class AudioQuantumList(list, AudioRenderable):
             raise TypeError("Source must be an instance of echonest.remix.audio.AudioData")
 
     durations  = property(get_many('duration'))
-    kinds      = property(get_many('kind'))
+    kinds      = property(get_kinds)
     start      = property(get_many('start'))
     confidence = property(get_many('confidence'))
 
@@ -1594,22 +2606,75 @@ class AudioQuantumList(list, AudioRenderable):
             ss.update(aq.sources())
         return ss
 
+    def _render_length(self, sampleRate):
+        "The length, in samples, of a new `AudioData` for `render`\()."
+        dur = 0
+        for aq in list.__iter__(self):
+            dur += int(aq.duration * sampleRate)
+        return dur
+
+    def compile(self, start=0.0):
+        "See `AudioRenderable.compile`\()."
+        tempsource = self.source or list.__getitem__(self, 0).source
+        plan = RenderPlan(tempsource.sampleRate, tempsource.numChannels)
+        plan.add_renderable(self, start)
+        plan.minimum = max(plan.minimum, self._render_length(tempsource.sampleRate))
+        return plan
+
+    def encode(self, filename):
+        """
+        Encodes the list to `filename` straight from its `RenderPlan`, one
+        block at a time, instead of rendering it all first.
+        """
+        return self.compile().encode(filename)
+
+    def _render_plan(self, start, to_audio):
+        "Renders through a `RenderPlan`, into `to_audio` or else a new `AudioData32`."
+        if to_audio:
+            plan = RenderPlan(to_audio.sampleRate, to_audio.numChannels)
+            plan.add_renderable(self, start)
+            plan.execute(to_audio)
+            return to_audio
+        return self.compile(start).render()
+
     def attach(self, container):
         """
         Create circular references to the containing `AudioAnalysis` and for the
         contained `AudioQuantum` objects.
         """
         self.container = container
-        for i in self:
+        for i in list.__iter__(self):
             i.container = self
+        self._attached = True
+        self._indexed_version = None
+        self._reindex()
+
+    def _reindex(self):
+        """
+        Records the position of each contained `AudioQuantum`, for its `prev`,
+        `next` and `absolute_context`. Returns False if nothing has changed
+        since the last time.
+        """
+        if self._indexed_version == self._version:
+            return False
+        # Backwards, so that a quantum listed twice keeps its first position
+        # as `list.index` would.
+        for position in xrange(len(self) - 1, -1, -1):
+            quantum = list.__getitem__(self, position)
+            if getattr(quantum, 'container', None) is self:
+                quantum._position = position
+        self._indexed_version = self._version
+        return True
 
     def __getstate__(self):
         """
         Eliminates the circular reference for pickling.
         """
         dictclone = self.__dict__.copy()
-        if 'container' in dictclone:
-            del dictclone['container']
+        for key in ('container', '_columns', '_attached', '_version',
+                    '_indexed_version'):
+            if key in dictclone:
+                del dictclone[key]
         return dictclone
 
     def toxml(self, context=None):
@@ -1635,21 +2700,8 @@ class AudioQuantumList(list, AudioRenderable):
     def render(self, start=0.0, to_audio=None, with_source=None):
         if len(self) < 1:
             return
-        if not to_audio:
-            dur = 0
-            tempsource = self.source or list.__getitem__(self, 0).source
-            for aq in list.__iter__(self):
-                dur += int(aq.duration * tempsource.sampleRate)
-            to_audio = self.init_audio_data(tempsource, dur)
         if not hasattr(with_source, 'data'):
-            for tsource in self.sources():
-                this_start = start
-                for aq in list.__iter__(self):
-                    aq.render(start=this_start, to_audio=to_audio, with_source=tsource)
-                    this_start += aq.duration
-                if tsource.defer:
-                    tsource.unload()
-            return to_audio
+            return self._render_plan(start, to_audio)
         else:
             if with_source not in self.sources():
                 return
@@ -1699,18 +2751,12 @@ class Simultaneous(AudioQuantumList):
         else:
             return minidom.parseString(xml).toprettyxml()
 
+    def _render_length(self, sampleRate):
+        return int(max(self.durations) * sampleRate)
+
     def render(self, start=0.0, to_audio=None, with_source=None):
-        if not to_audio:
-            tempsource = self.source or list.__getitem__(self, 0).source
-            dur = int(max(self.durations) * tempsource.sampleRate)
-            to_audio = self.init_audio_data(tempsource, dur)
         if not hasattr(with_source, 'data'):
-            for source in self.sources():
-                for aq in list.__iter__(self):
-                    aq.render(start=start, to_audio=to_audio, with_source=source)
-                if source.defer:
-                    source.unload()
-            return to_audio
+            return self._render_plan(start, to_audio)
         else:
             if with_source not in self.sources():
                 return
@@ -1720,44 +2766,79 @@ class Simultaneous(AudioQuantumList):
 
 # Used for creating bars, beats, and tatums
 def _dataParser(tag, nodes):
-    out = AudioQuantumList(kind=tag)
-    for n in nodes:
-        out.append(AudioQuantum(start=n['start'], kind=tag, confidence=n['confidence']))
-    if len(out) > 1:
-        for i in range(len(out) - 1) :
-            out[i].duration = out[i + 1].start - out[i].start
-        out[-1].duration = out[-2].duration
-    return out
+    return _columnsParser(tag, event_columns(tag + 's', nodes))
 
 # Used for creating sections
 def _attributeParser(tag, nodes):
-    out = AudioQuantumList(kind=tag)
-    for n in nodes:
-        # Make sure that we do not break due to an old analysis file
-        try:
-            out.append(AudioQuantum(start=n['start'], duration=n['duration'], kind=tag, 
-                                    key=n['key'], key_confidence=n['key_confidence'], 
-                                    mode=n['mode'], mode_confidence=n['mode_confidence'], 
-                                    tempo=n['tempo'], tempo_confidence=n['tempo_confidence'], 
-                                    time_signature=n['time_signature'], 
-                                    time_signature_confidence=n['time_signature_confidence'],
-                                    loudness=n['loudness']))
-        except KeyError:
-              out.append(AudioQuantum(start=n['start'], duration=n['duration'], kind=tag)) 
-    return out
+    return _columnsParser(tag, event_columns(tag + 's', nodes))
 
 # Used for creating segments
 def _segmentsParser(nodes):
-    out = AudioQuantumList(kind='segment')
-    for n in nodes:
-        out.append(AudioSegment(start=n['start'], duration=n['duration'],
-                                pitches=n['pitches'], timbre=n['timbre'],
-                                loudness_begin=n['loudness_start'],
-                                loudness_max=n['loudness_max'],
-                                time_loudness_max=n['loudness_max_time'],
-                                loudness_end=n.get('loudness_end')))
+    return _columnsParser('segment', event_columns('segments', nodes))
+
+def _none_if_nan(value):
+    return None if value != value else value
+
+# Used for creating any kind of AudioQuantum from the columns of an analysis
+def _columnsParser(tag, columns):
+    began = time.time()
+    starts = columns['start'].tolist()
+    durations = columns['duration'].tolist()
+    quanta = []
+    kept = {'start': columns['start']}
+    if tag == 'segment':
+        pitches = columns['pitches']
+        timbre = columns['timbre']
+        for i, n in enumerate(zip(starts, durations, columns['loudness_start'].tolist(),
+                                  columns['loudness_max'].tolist(),
+                                  columns['loudness_max_time'].tolist(),
+                                  columns['loudness_end'].tolist())):
+            # Each segment's vectors are views of the shared N x 12 columns.
+            quanta.append(AudioSegment(start=n[0], duration=n[1],
+                                       pitches=pitches[i], timbre=timbre[i],
+                                       loudness_begin=n[2], loudness_max=n[3],
+                                       time_loudness_max=n[4],
+                                       loudness_end=_none_if_nan(n[5])))
+        kept.update(duration=columns['duration'], pitches=pitches, timbre=timbre,
+                    loudness_begin=columns['loudness_start'],
+                    loudness_max=columns['loudness_max'],
+                    time_loudness_max=columns['loudness_max_time'])
+    elif tag == 'section':
+        fields = ('confidence', 'key', 'key_confidence', 'mode', 'mode_confidence',
+                  'tempo', 'tempo_confidence', 'time_signature',
+                  'time_signature_confidence', 'loudness')
+        values = zip(*[columns[field].tolist() for field in fields]) or [()] * len(starts)
+        for start, duration, attributes in zip(starts, durations, values):
+            kwargs = dict((f, _none_if_nan(v)) for f, v in zip(fields, attributes))
+            for field in ('key', 'mode', 'time_signature'):
+                if kwargs.get(field) is not None:
+                    kwargs[field] = int(kwargs[field])
+            quanta.append(AudioQuantum(start=start, duration=duration, kind=tag, **kwargs))
+        kept.update(duration=columns['duration'])
+    else:
+        # Durations come from the following start times, not from the analysis.
+        durations = numpy.zeros(len(starts))
+        if len(starts) > 1:
+            durations[:-1] = numpy.diff(columns['start'])
+            durations[-1] = durations[-2]
+        for start, duration, confidence in zip(starts, durations.tolist(),
+                                               columns['confidence'].tolist()):
+            quanta.append(AudioQuantum(start=start, duration=duration, kind=tag,
+                                       confidence=_none_if_nan(confidence)))
+        kept.update(duration=durations)
+        if not numpy.isnan(columns['confidence']).any():
+            kept.update(confidence=columns['confidence'])
+    out = AudioQuantumList(quanta, kind=tag)
+    out._columns = dict((name, _read_only(column)) for name, column in kept.items())
+    instrument.record('parse', began, bytes=sum(c.nbytes for c in columns.values()),
+                      peak=max([c.nbytes for c in kept.values()] or [0]), kind=tag, count=len(out))
     return out
 
+def _read_only(ndarray):
+    view = ndarray.view()
+    view.flags.writeable = False
+    return view
+
 class FileTypeError(Exception):
     def __init__(self, filename, message):
         self.filename = filename
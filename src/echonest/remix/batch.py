@@ -0,0 +1,222 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+batch.py
+
+Runs a remix function over many inputs in a pool of worker processes, so a
+batch pays for interpreter start-up and imports once per worker instead of
+once per file. Workers share the local analysis and audio cache (see
+`local_db`), which is safe to use from several processes at once.
+
+Sample usage::
+
+    def reverse(filename):
+        audiofile = audio.LocalAudioFile(filename)
+        chunks = audiofile.analysis.beats
+        chunks.reverse()
+        out = filename + '.reversed.mp3'
+        audio.getpieces(audiofile, chunks).encode(out)
+        return out
+
+    for result in batch.run(reverse, filenames, timeout=300):
+        if result.error:
+            print result.input, 'failed:', result.error
+        else:
+            print result.input, '->', result.value
+
+The remix function must be defined at the top level of a module (or be a
+`functools.partial` of one) so that the workers can unpickle it.
+"""
+
+import time
+import errno
+import Queue
+import signal
+import logging
+import traceback
+import multiprocessing
+from multiprocessing.queues import SimpleQueue
+from collections import namedtuple
+
+from support.ffmpeg import FFMPEGError
+
+LOG = logging.getLogger(__name__)
+
+# Times a job is tried again after a transient failure.
+RETRIES = 2
+
+# Seconds to wait before the first retry; doubled for each one after that.
+RETRY_DELAY = 1.0
+
+# Seconds the parent waits for each result. Waiting with a timeout, however
+# long, keeps the wait interruptible with Ctrl-C.
+RESULT_WAIT = 60 * 60 * 24 * 365
+
+# Seconds past a job's timeout that the parent waits before giving up on it,
+# in case its worker died (was killed, or crashed) without reporting back.
+TIMEOUT_MARGIN = 30
+
+# Seconds between checks for such jobs, when there is a timeout.
+POLL_INTERVAL = 1.0
+
+# OS errors that are worth trying again, such as failing to start ffmpeg.
+TRANSIENT_ERRNOS = (errno.EAGAIN, errno.ENOMEM, errno.EINTR)
+
+class Result(namedtuple('Result', 'index input value error attempts elapsed')):
+    """
+    The outcome of one job: the position and value of its `input` in the
+    list given to `run`, the `value` returned by the remix function, or else
+    `error`, the traceback of the failure as a string. `attempts` is the
+    number of tries the job took, and `elapsed` is in seconds.
+    """
+    __slots__ = ()
+
+
+class JobTimeout(BaseException):
+    """
+    Raised inside a worker when a job runs past its timeout. Like
+    `KeyboardInterrupt`, it is not an `Exception`, so that `except Exception`
+    in the remix function doesn't swallow it.
+    """
+    pass
+
+
+def is_transient(error):
+    """
+    True if `error` is a failure that may not happen again, such as an
+    ffmpeg error classified as transient by `ffmpeg_error_check`.
+    """
+    if isinstance(error, FFMPEGError):
+        return error.transient
+    if isinstance(error, EnvironmentError):
+        return error.errno in TRANSIENT_ERRNOS
+    return False
+
+
+# The queue on which a worker tells the parent when it starts each job.
+_started = None
+
+
+def _init_worker(started=None):
+    global _started
+    _started = started
+    # Leave Ctrl-C to the parent, which tears down the pool.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def _alarm(signum, frame):
+    raise JobTimeout()
+
+
+def _run_job(job):
+    """
+    Runs one job in a worker, retrying transient failures, and returns its
+    `Result`. Nothing is raised, as exceptions may not survive pickling.
+    """
+    remix, index, item, timeout, retries = job
+    started = time.time()
+    if _started is not None:
+        _started.put((index, started))
+    attempts = 0
+    value = error = None
+    timed = timeout and hasattr(signal, 'setitimer')
+    if timed:
+        previous = signal.signal(signal.SIGALRM, _alarm)
+    try:
+        try:
+            if timed:
+                signal.setitimer(signal.ITIMER_REAL, timeout)
+            while True:
+                attempts += 1
+                try:
+                    value = remix(item)
+                    break
+                except Exception, e:
+                    if attempts > retries or not is_transient(e):
+                        raise
+                    LOG.warning("Retrying %r after transient error: %s", item, e)
+                    time.sleep(RETRY_DELAY * 2 ** (attempts - 1))
+        finally:
+            # The alarm may still go off in here, but not once it is cleared.
+            if timed:
+                signal.setitimer(signal.ITIMER_REAL, 0)
+    except JobTimeout:
+        error = "Timed out after %s seconds" % timeout
+    except Exception:
+        error = traceback.format_exc()
+    finally:
+        if timed:
+            signal.signal(signal.SIGALRM, previous)
+    elapsed = time.time() - started
+    # Catches jobs that swallowed the alarm with a bare except, and
+    # platforms without one.
+    if error is None and timeout and elapsed > timeout:
+        error = "Timed out after %s seconds" % timeout
+    if error is not None:
+        value = None
+    return Result(index, item, value, error, attempts, elapsed)
+
+
+def run(remix, inputs, processes=None, timeout=None, retries=RETRIES, maxtasksperchild=None):
+    """
+    Calls `remix` on each of `inputs` across a pool of `processes` worker
+    processes (by default, one per CPU), yielding a `Result` for each as it
+    finishes, in no particular order.
+
+    :param remix: a picklable function of one argument
+    :param inputs: the arguments, usually filenames
+    :param timeout: seconds each job may take, retries included (Unix only).
+        A job whose worker dies is reported as a TimeoutError once it is
+        TIMEOUT_MARGIN seconds past this.
+    :param retries: times to retry a job after a transient failure
+    :param maxtasksperchild: jobs each worker runs before it is replaced,
+        to bound the memory held by long-running workers
+    """
+    jobs = [(remix, index, item, timeout, retries) for index, item in enumerate(inputs)]
+    if not jobs:
+        return
+    # Written to straight from the worker, with no feeder thread that a
+    # killed worker could take its last message down with.
+    started = SimpleQueue() if timeout else None
+    results = Queue.Queue()
+    pool = multiprocessing.Pool(processes, _init_worker, (started,),
+                                maxtasksperchild=maxtasksperchild)
+    pending = set(xrange(len(jobs)))
+    # When each job that has started must have finished by.
+    deadlines = {}
+    abandoned = False
+    finished = False
+    try:
+        for job in jobs:
+            pool.apply_async(_run_job, (job,), callback=results.put)
+        while pending:
+            try:
+                result = results.get(True, POLL_INTERVAL if timeout else RESULT_WAIT)
+            except Queue.Empty:
+                result = None
+            if result is not None and result.index in pending:
+                pending.remove(result.index)
+                yield result
+            if not timeout:
+                continue
+            while not started.empty():
+                index, when = started.get()
+                deadlines[index] = when
+            now = time.time()
+            for index in sorted(pending):
+                if index in deadlines and deadlines[index] + timeout + TIMEOUT_MARGIN < now:
+                    # Its worker is gone; the pool replaces the worker, but
+                    # never the job.
+                    pending.remove(index)
+                    abandoned = True
+                    error = "TimeoutError: the worker did not report back within %s seconds" \
+                            % (timeout + TIMEOUT_MARGIN)
+                    yield Result(index, jobs[index][2], None, error, 1, now - deadlines[index])
+        finished = True
+    finally:
+        # A pool with abandoned jobs never finishes closing.
+        if finished and not abandoned:
+            pool.close()
+        else:
+            pool.terminate()
+        pool.join()
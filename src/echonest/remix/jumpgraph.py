@@ -0,0 +1,321 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+jumpgraph.py
+
+A graph of the jumps a track can make between its beats (or other quanta),
+for making a track longer, shorter or endless by jumping between similar
+places in it (see examples/earworm).
+
+Nodes are the indices of the quanta. Every quantum leads on to the next
+one; a jump u -> v means that after playing quantum u, playback can carry
+on from the start of quantum v instead of u + 1. The jumps are kept as
+arrays in compressed sparse row form: the jumps from quantum u are
+`targets[indptr[u]:indptr[u + 1]]`, with their `costs` (how different
+the two places sound), cheapest first.
+
+Sample usage::
+
+    graph = JumpGraph.from_paths(starts, durations, paths)
+    jumps = graph.path(600.0)
+    actions = graph.actions(track, 0, jumps, len(graph) - 1)
+"""
+
+from collections import deque
+
+import numpy
+
+
+class JumpGraph(object):
+    """
+    The jumps between the quanta of a track, which start at `starts` and
+    last `durations` seconds. `sources`, `targets` and `costs` list the
+    jumps; any from a quantum to the next one are left out, as playback
+    gets there anyway.
+    """
+    def __init__(self, starts, durations, sources=(), targets=(), costs=()):
+        self.starts = numpy.asarray(starts, dtype=numpy.float64)
+        self.durations = numpy.asarray(durations, dtype=numpy.float64)
+        sources = numpy.asarray(sources, dtype=numpy.intp)
+        targets = numpy.asarray(targets, dtype=numpy.intp)
+        costs = numpy.asarray(costs, dtype=numpy.float64)
+        n = len(self.starts)
+        keep = (targets != sources + 1) & (sources >= 0) & (sources < n) & \
+               (targets >= 0) & (targets < n)
+        sources, targets, costs = sources[keep], targets[keep], costs[keep]
+        # One jump for each pair of quanta, the last one given.
+        pairs = sources * n + targets
+        unused, last = numpy.unique(pairs[::-1], return_index=True)
+        last = len(pairs) - 1 - last
+        sources, targets, costs = sources[last], targets[last], costs[last]
+        order = numpy.lexsort((targets, costs, sources))
+        self.sources = sources[order]
+        self.targets = targets[order]
+        self.costs = costs[order]
+        self.indptr = numpy.zeros(n + 1, dtype=numpy.intp)
+        numpy.cumsum(numpy.bincount(self.sources, minlength=n), out=self.indptr[1:])
+
+    @classmethod
+    def from_paths(cls, starts, durations, paths):
+        """
+        Makes the graph of earworm's loop points: `paths[i]` lists the
+        `(j, distance)` of the quanta j that sound like quantum i, so that
+        playback can go on from quantum j + 1 after playing quantum i.
+        """
+        sources = [i for i, path in enumerate(paths) for j, distance in path]
+        targets = [j + 1 for path in paths for j, distance in path]
+        costs = [distance for path in paths for j, distance in path]
+        return cls(starts, durations, sources, targets, costs)
+
+    def __len__(self):
+        return len(self.starts)
+
+    def jumps_from(self, u):
+        "The indices of the jumps from quantum `u`, cheapest first."
+        return numpy.arange(self.indptr[u], self.indptr[u + 1])
+
+    def gains(self, jumps=None):
+        """
+        The seconds each of `jumps` (by default, all of them) adds to the
+        playing time: positive for jumps back, negative for jumps ahead.
+        """
+        if jumps is None:
+            jumps = slice(None)
+        sources, targets = self.sources[jumps], self.targets[jumps]
+        return self.durations[sources] - (self.starts[targets] - self.starts[sources])
+
+    def jumps(self, mode='backward', first=0, last=None):
+        """
+        Returns the indices of the jumps back ('backward') or ahead
+        ('forward') between quanta `first` to `last`, the ones that change
+        the playing time most first.
+        """
+        if last is None:
+            last = len(self) - 1
+        within = (self.sources >= first) & (self.sources <= last) & \
+                 (self.targets >= first) & (self.targets <= last)
+        if mode == 'backward':
+            chosen = numpy.nonzero(within & (self.targets < self.sources))[0]
+            change = self.gains(chosen)
+        elif mode == 'forward':
+            chosen = numpy.nonzero(within & (self.targets > self.sources + 1))[0]
+            change = -self.gains(chosen)
+        else:
+            raise ValueError("mode must be 'backward' or 'forward'")
+        return chosen[numpy.lexsort((self.costs[chosen], -change))]
+
+    def pruned(self, minimum):
+        """
+        Returns a copy of the graph without the jumps that skip ahead by
+        `minimum` quanta or less, or loop back over fewer than `minimum`.
+        """
+        distance = self.targets - self.sources
+        keep = (minimum < distance) | (distance <= -minimum + 1)
+        return JumpGraph(self.starts, self.durations, self.sources[keep],
+                         self.targets[keep], self.costs[keep])
+
+    def duration(self, start, jumps, end):
+        "The seconds it takes to play from quantum `start` to `end` taking `jumps`."
+        total = 0.0
+        position = self.starts[start]
+        for jump in jumps:
+            u, v = self.sources[jump], self.targets[jump]
+            total += self.starts[u] - position + self.durations[u]
+            position = self.starts[v]
+        return total + self.starts[end] - position
+
+    def shortest_path(self, start, end, first=0, last=None, backward=False):
+        """
+        Finds the way from quantum `start` to quantum `end` that takes the
+        fewest steps (playing on, or jumping) without leaving quanta `first`
+        to `last`, using only jumps back if `backward`. Returns the indices
+        of the jumps taken, in order, or None if there is no way.
+        """
+        if last is None:
+            last = len(self) - 1
+        # The jump (or -1, for playing on) that first reached each quantum.
+        parents = {start: None}
+        queue = deque([start])
+        while queue and end not in parents:
+            u = queue.popleft()
+            steps = [(self.targets[jump], jump) for jump in self.jumps_from(u)]
+            steps.append((u + 1, -1))
+            for v, jump in steps:
+                if v in parents or not first <= v <= last:
+                    continue
+                if backward and jump >= 0 and v > u:
+                    continue
+                parents[v] = (u, jump)
+                queue.append(v)
+        if end not in parents:
+            return None
+        jumps = []
+        v = end
+        while parents[v] is not None:
+            u, jump = parents[v]
+            if jump >= 0:
+                jumps.append(jump)
+            v = u
+        jumps.reverse()
+        return jumps
+
+    def path(self, target, first=0, last=None):
+        """
+        Chooses jumps for playing from quantum `first` to quantum `last`
+        (by default, all of them) in about `target` seconds: the longest
+        jumps ahead that fit, without overlapping, to make it shorter, or
+        the longest loops back that fit (each used once before any is used
+        again) to make it longer. A `target` of zero takes the way with the
+        fewest steps. Returns the indices of the jumps in the order they are
+        taken; in between, playback carries on from one quantum to the next.
+        """
+        if last is None:
+            last = len(self) - 1
+        duration = self.starts[last] - self.starts[first]
+        if target <= 0:
+            return self.shortest_path(first, last, first, last) or []
+        chosen = []
+        if target < duration:
+            remaining = duration - target
+            skips = self.jumps('forward', first, last)
+            for jump, saved in zip(skips, -self.gains(skips)):
+                if remaining <= 0:
+                    break
+                if saved > remaining:
+                    continue
+                u, v = self.sources[jump], self.targets[jump]
+                if any(u < self.targets[c] and self.sources[c] < v for c in chosen):
+                    continue
+                chosen.append(jump)
+                remaining -= saved
+        elif duration < target:
+            remaining = target - duration
+            loops = list(self.jumps('backward', first, last))
+            gains = dict(zip(loops, self.gains(loops)))
+            unused = []
+            while 0 < remaining and loops:
+                if not unused:
+                    unused = list(loops)
+                for jump in unused:
+                    if gains[jump] <= remaining:
+                        break
+                else:
+                    # None fits: the shortest overshoots least.
+                    jump = unused[-1]
+                unused.remove(jump)
+                chosen.append(jump)
+                remaining -= gains[jump]
+        chosen.sort(key=lambda jump: self.sources[jump])
+        return chosen
+
+    def _degree(self, node, first, last, backs, into):
+        "The number of steps to or from `node` within `first` to `last`."
+        degree = int(first <= node - 1) + int(node + 1 <= last)
+        for others in (backs.get(node, ()), into.get(node, ())):
+            degree += sum(1 for other in others if first <= other <= last)
+        return degree
+
+    def loop(self, target):
+        """
+        Chooses jumps for an endless loop that lasts about `target` seconds
+        each time around: from some quantum `first` on to a quantum `last`,
+        then back to `first` through jumps back, using the quanta with a
+        jump back to or from them nearest to either end of the track. Returns
+        `first` and the indices of the jumps, or None if there is no loop.
+        """
+        backs, into = {}, {}
+        for jump in self.jumps('backward'):
+            u, v = self.sources[jump], self.targets[jump]
+            backs.setdefault(u, []).append(v)
+            into.setdefault(v, []).append(u)
+
+        # As in earworm's old networkx version, whose subgraph of jumps back
+        # also held the steps from each quantum to the next: an end quantum
+        # has one step on, so it goes if no jump back reaches or leaves it.
+        def trim(first, last):
+            while first < last and self._degree(first, first, last, backs, into) <= 1:
+                first += 1
+            while first < last and self._degree(last, first, last, backs, into) <= 1:
+                last -= 1
+            return first, last
+
+        first, last = trim(0, len(self) - 1)
+        drop_first = True
+        while first < last:
+            back = self.shortest_path(last, first, first, last, backward=True)
+            if back is not None:
+                break
+            if drop_first:
+                first += 1
+            else:
+                last -= 1
+            drop_first = not drop_first
+            first, last = trim(first, last)
+        else:
+            return None
+        around = self.duration(last, back, first)
+        return first, self.path(max(target - around, 0), first, last) + back
+
+    def actions(self, track, start, jumps, end=None):
+        """
+        Returns the `action.Playback` and `action.Jump` objects that play
+        `track` from quantum `start` taking `jumps`, then on to the start of
+        quantum `end`, if given.
+        """
+        # Imported here, so that building graphs doesn't need the compiled
+        # extensions that `action` does.
+        from action import Playback, Jump
+        actions = []
+        position = self.starts[start]
+        for jump in jumps:
+            u, v = self.sources[jump], self.targets[jump]
+            if 0 < self.starts[u] - position:
+                actions.append(Playback(track, position, self.starts[u] - position))
+            actions.append(Jump(track, self.starts[u], self.starts[v], self.durations[u]))
+            position = self.starts[v]
+        if end is not None and 0 < self.starts[end] - position:
+            actions.append(Playback(track, position, self.starts[end] - position))
+        return actions
+
+    def save(self, filename):
+        "Saves the graph to `filename` in NumPy's .npz format."
+        with open(filename, 'wb') as f:
+            numpy.savez(f, starts=self.starts, durations=self.durations,
+                        sources=self.sources, targets=self.targets, costs=self.costs)
+
+    @classmethod
+    def load(cls, filename):
+        "Loads a graph saved by `save`."
+        with open(filename, 'rb') as f:
+            arrays = numpy.load(f)
+            return cls(arrays['starts'], arrays['durations'], arrays['sources'],
+                       arrays['targets'], arrays['costs'])
+
+    def write_gml(self, filename):
+        "Writes the quanta and every step between them to `filename` as GML."
+        with open(filename, 'w') as f:
+            f.write('graph [\n  directed 1\n')
+            for node, start in enumerate(self.starts):
+                f.write('  node [ id %d label "%r" ]\n' % (node, start))
+            for u, v, cost in self._steps():
+                f.write('  edge [ source %d target %d distance %r duration %r ]\n'
+                        % (u, v, cost, self.durations[u]))
+            f.write(']\n')
+
+    def write_dot(self, filename):
+        """
+        Writes every step between quanta, by index, to `filename` as a
+        Graphviz graph, e.g. for `dot -Tpng`.
+        """
+        with open(filename, 'w') as f:
+            f.write('digraph jumps {\n')
+            for u, v, cost in self._steps():
+                f.write('  %d -> %d;\n' % (u, v))
+            f.write('}\n')
+
+    def _steps(self):
+        "Yields (u, v, cost) for playing on from each quantum, then for each jump."
+        for u in xrange(len(self) - 1):
+            yield u, u + 1, 0.0
+        for u, v, cost in zip(self.sources, self.targets, self.costs):
+            yield u, v, cost
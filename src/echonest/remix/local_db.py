@@ -4,12 +4,25 @@
 local_db.py
 
 Functions for saving analysis and wave files to local storage
+
+The files live under ~/.remix-db, indexed by an SQLite database in WAL mode,
+so lookups are O(1) and several processes can read and write the cache at
+the same time.
 """
 
 import os
 import json
+import atexit
+import time
+import errno
+import hashlib
 import shutil
+import struct
+import zipfile
 import logging
+import sqlite3
+import tempfile
+import numpy
 
 LOG = logging.getLogger(__name__)
 HOME = os.path.expanduser("~")
@@ -17,58 +30,461 @@ REMIX_PATH = '.remix-db'
 REMIX_FOLDER = HOME + os.path.sep + REMIX_PATH
 AUDIO_FOLDER = REMIX_FOLDER + os.path.sep + 'audio'
 ANALYSIS_FOLDER = REMIX_FOLDER + os.path.sep + 'analysis'
+# The flat list of MD5s used by older versions; imported into INDEX once.
 DATABASE = REMIX_FOLDER + os.path.sep + 'database.db'
+INDEX = REMIX_FOLDER + os.path.sep + 'index.sqlite'
+
+# Seconds a writer waits for another process to release the index.
+LOCK_TIMEOUT = 60
+
+# Bytes read at a time when hashing a file.
+HASH_CHUNK_SIZE = 1 << 20
+
+# Byte budget for the cached audio and analysis files, evicted least recently
+# used first. None means the cache grows without bound. Can be monkey-patched,
+# or set with the REMIX_DB_MAX_BYTES environment variable.
+MAX_CACHE_BYTES = int(os.environ['REMIX_DB_MAX_BYTES']) if 'REMIX_DB_MAX_BYTES' in os.environ else None
+# If True, eviction only deletes cached audio and keeps the (much smaller)
+# analyses, which are expensive to fetch again.
+KEEP_ANALYSIS = False
+
+# Hit and miss counts, and the access times that eviction goes by, are kept in
+# memory and written to the index at most every this many seconds, before
+# eviction, when `cache_stats` is called and at exit, rather than on every
+# lookup. 0 writes them straight away.
+STATS_FLUSH_INTERVAL = 10
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS tracks (
+    md5 TEXT PRIMARY KEY,
+    audio_bytes INTEGER,
+    analysis_bytes INTEGER,
+    created REAL NOT NULL,
+    last_access REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS tracks_last_access ON tracks (last_access);
+CREATE TABLE IF NOT EXISTS fingerprints (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime REAL NOT NULL,
+    inode INTEGER NOT NULL,
+    md5 TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS stats (
+    name TEXT PRIMARY KEY,
+    count INTEGER NOT NULL
+);
+"""
+
+# Per-event fields of each list in an analysis, stored as one float32 column
+# each ('start' and 'duration' are stored as float64, to stay sample-accurate
+# on long tracks). Missing values are stored as NaN.
+ANALYSIS_FIELDS = {
+    'bars': ('confidence',),
+    'beats': ('confidence',),
+    'tatums': ('confidence',),
+    'sections': ('confidence', 'loudness', 'tempo', 'tempo_confidence',
+                 'key', 'key_confidence', 'mode', 'mode_confidence',
+                 'time_signature', 'time_signature_confidence'),
+    'segments': ('confidence', 'loudness_start', 'loudness_max',
+                 'loudness_max_time', 'loudness_end', 'pitches', 'timbre'),
+}
+VECTOR_FIELDS = ('pitches', 'timbre')
+
+STAT_NAMES = ('audio_hits', 'audio_misses', 'analysis_hits', 'analysis_misses', 'evictions')
+
+_connection = None
+_connection_pid = None
+
+# Counts and access times not yet written to the index, for this process.
+_pending_counts = {}
+_pending_access = {}
+_pending_pid = None
+_pending_since = 0
+
+def _connect():
+    '''Return this process's connection to the index, opening it if needed.'''
+    global _connection, _connection_pid
+    # sqlite connections must not be shared across a fork.
+    if _connection is None or _connection_pid != os.getpid():
+        _connection = sqlite3.connect(INDEX, timeout=LOCK_TIMEOUT,
+                                      isolation_level=None)
+        _connection.execute('PRAGMA journal_mode=WAL')
+        _connection.execute('PRAGMA synchronous=NORMAL')
+        _connection.executescript(SCHEMA)
+        _connection_pid = os.getpid()
+    return _connection
+
+def _makedirs(path):
+    try:
+        os.makedirs(path)
+    except OSError as e:
+        # Another process may have created it in the meantime.
+        if e.errno != errno.EEXIST:
+            raise
 
 def check_and_create_local_db():
     '''If the local db does not exist, create it.'''
-    home_dir = os.listdir(HOME)
-    if REMIX_PATH in home_dir:
+    if os.path.exists(INDEX):
         LOG.info("Found local database.")
+        _connect()
         return
-    else:
-        LOG.info("Local database not found, creating...")
+    LOG.info("Local database not found, creating...")
+    _makedirs(AUDIO_FOLDER)
+    _makedirs(ANALYSIS_FOLDER)
+    _connect()
+    _import_legacy_db()
+    LOG.info("Local database created.")
+
+def _import_legacy_db():
+    '''Index the tracks listed in an old flat database.db, if there is one.'''
+    if not os.path.exists(DATABASE):
+        return
+    with open(DATABASE, 'r') as db_file:
+        md5s = set(line.strip() for line in db_file if line.strip())
+    now = time.time()
+    rows = []
+    for track_md5 in md5s:
+        audio_file = get_audio_file(track_md5, touch=False)
+        json_file = ANALYSIS_FOLDER + os.path.sep + track_md5 + '.analysis'
+        if os.path.exists(audio_file) and os.path.exists(json_file):
+            with open(json_file, 'rb') as f:
+                analysis_bytes = _write_analysis(track_md5, json.load(f))
+            os.remove(json_file)
+            rows.append((track_md5, os.path.getsize(audio_file),
+                         analysis_bytes, now, now))
+    _transaction(_connect(), [('INSERT OR IGNORE INTO tracks VALUES (?, ?, ?, ?, ?)', row)
+                              for row in rows])
+    LOG.info("Imported %d tracks from %s.", len(rows), DATABASE)
 
-        os.mkdir(REMIX_FOLDER)
-        os.mkdir(AUDIO_FOLDER)
-        os.mkdir(ANALYSIS_FOLDER)
+def _transaction(connection, statements):
+    '''Run (sql, args) pairs in one write transaction.'''
+    connection.execute('BEGIN IMMEDIATE')
+    try:
+        for sql, args in statements:
+            connection.execute(sql, args)
+        connection.execute('COMMIT')
+    except Exception:
+        connection.execute('ROLLBACK')
+        raise
+
+def _pending():
+    '''Return this process's unwritten counts and access times.'''
+    global _pending_pid
+    # A forked child starts with a copy of its parent's, which aren't its own.
+    if _pending_pid != os.getpid():
+        _pending_counts.clear()
+        _pending_access.clear()
+        _pending_pid = os.getpid()
+    return _pending_counts, _pending_access
+
+def _queue():
+    '''Return the pending counts and access times to add to.'''
+    global _pending_since
+    counts, access = _pending()
+    if not counts and not access:
+        _pending_since = time.time()
+    return counts, access
+
+def _flush(force=True):
+    '''
+    Write the pending counts and access times to the index in one transaction,
+    unless neither force is given nor STATS_FLUSH_INTERVAL has passed since
+    the first of them.
+    '''
+    counts, access = _pending()
+    if not counts and not access:
+        return
+    if not force and time.time() - _pending_since < STATS_FLUSH_INTERVAL:
+        return
+    statements = []
+    for name, count in counts.items():
+        statements.append(('INSERT OR IGNORE INTO stats VALUES (?, 0)', (name,)))
+        statements.append(('UPDATE stats SET count = count + ? WHERE name = ?', (count, name)))
+    for track_md5, last_access in access.items():
+        # The track may have been saved again since, with a later time.
+        statements.append(('UPDATE tracks SET last_access = MAX(last_access, ?) WHERE md5 = ?',
+                           (last_access, track_md5)))
+    _transaction(_connect(), statements)
+    counts.clear()
+    access.clear()
 
-        db_file = open(DATABASE, 'wb')
-        db_file.close()
-        LOG.info("Local database created.")
+@atexit.register
+def _flush_at_exit():
+    try:
+        _flush()
+    except sqlite3.Error:
+        LOG.warning("Could not save the local database's statistics.", exc_info=True)
+
+def _count(name):
+    counts, access = _queue()
+    counts[name] = counts.get(name, 0) + 1
+    _flush(force=False)
+
+def _stat_key(path):
+    st = os.stat(path)
+    return (st.st_size, st.st_mtime, st.st_ino)
+
+def file_md5(filename):
+    '''
+    Return the MD5 of a file, as used to key the db. Digests are remembered by
+    path, size, mtime and inode, so an unchanged file is never read twice;
+    otherwise the file is hashed in HASH_CHUNK_SIZE chunks.
+    '''
+    path = os.path.abspath(filename)
+    key = _stat_key(path)
+    connection = _connect()
+    row = connection.execute('SELECT size, mtime, inode, md5 FROM fingerprints WHERE path = ?',
+                             (path,)).fetchone()
+    if row is not None and tuple(row[:3]) == key:
+        return str(row[3])
+
+    digest = hashlib.md5()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), ''):
+            digest.update(chunk)
+    track_md5 = digest.hexdigest()
+    # Don't remember a digest of a file that changed while we read it.
+    if _stat_key(path) == key:
+        _transaction(connection, [('INSERT OR REPLACE INTO fingerprints VALUES (?, ?, ?, ?, ?)',
+                                   (path,) + key + (track_md5,))])
+    return track_md5
+
+def _lookup(track_md5, column, target_file):
+    '''Check one kind of cached file, counting the hit or miss.'''
+    kind = column.split('_')[0]
+    row = _connect().execute('SELECT %s FROM tracks WHERE md5 = ?' % column,
+                             (track_md5,)).fetchone()
+    # Another process may have evicted the file since it was indexed.
+    hit = row is not None and row[0] is not None and os.path.exists(target_file)
+    _count(kind + ('_hits' if hit else '_misses'))
+    return hit
+
+def has_audio(track_md5):
+    '''Check the DB and see if the audio of the track is cached.'''
+    return _lookup(track_md5, 'audio_bytes', get_audio_file(track_md5, touch=False))
+
+def has_analysis(track_md5):
+    '''Check the DB and see if the analysis of the track is cached.'''
+    return _lookup(track_md5, 'analysis_bytes', get_analysis_file(track_md5, touch=False))
 
 def check_db(track_md5):
     '''Check the DB and see if the track is in it.'''
-    with open(DATABASE, 'r') as db_file:
-        for line in db_file:
-            if track_md5 == line.strip():
-                return True
-    return False
+    row = _connect().execute('SELECT audio_bytes, analysis_bytes FROM tracks WHERE md5 = ?',
+                             (track_md5,)).fetchone()
+    return row is not None and None not in row
+
+def cache_stats():
+    '''
+    Return a dict with the hit, miss and eviction counts of the cache, and
+    the number of tracks and bytes it currently holds.
+    '''
+    _flush()
+    connection = _connect()
+    stats = dict.fromkeys(STAT_NAMES, 0)
+    stats.update(connection.execute('SELECT name, count FROM stats').fetchall())
+    tracks, audio_bytes, analysis_bytes = connection.execute(
+        'SELECT COUNT(*), SUM(audio_bytes), SUM(analysis_bytes) FROM tracks').fetchone()
+    stats['tracks'] = tracks
+    stats['audio_bytes'] = audio_bytes or 0
+    stats['analysis_bytes'] = analysis_bytes or 0
+    return stats
+
+def _remove(target_file):
+    try:
+        os.remove(target_file)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+
+def evict(max_bytes=None, keep_analysis=None):
+    '''
+    Delete least recently used files until the cache holds at most max_bytes
+    (MAX_CACHE_BYTES by default). With keep_analysis (KEEP_ANALYSIS by
+    default), only audio files are deleted. Returns the number of bytes freed.
+    '''
+    if max_bytes is None:
+        max_bytes = MAX_CACHE_BYTES
+    if keep_analysis is None:
+        keep_analysis = KEEP_ANALYSIS
+    if max_bytes is None:
+        return 0
+    # Evict by up-to-date access times.
+    _flush()
+    connection = _connect()
+    connection.execute('BEGIN IMMEDIATE')
+    try:
+        total = connection.execute('SELECT SUM(COALESCE(audio_bytes, 0) + '
+                                   'COALESCE(analysis_bytes, 0)) FROM tracks').fetchone()[0] or 0
+        freed = 0
+        evicted = 0
+        query = 'SELECT md5, audio_bytes, analysis_bytes FROM tracks '
+        if keep_analysis:
+            # Analyses stay, so only tracks with audio have anything to free.
+            query += 'WHERE audio_bytes IS NOT NULL '
+        rows = connection.execute(query + 'ORDER BY last_access').fetchall()
+        for track_md5, audio_bytes, analysis_bytes in rows:
+            if total - freed <= max_bytes:
+                break
+            if audio_bytes is not None:
+                _remove(get_audio_file(track_md5, touch=False))
+                freed += audio_bytes
+            if keep_analysis and analysis_bytes is not None:
+                connection.execute('UPDATE tracks SET audio_bytes = NULL WHERE md5 = ?',
+                                   (track_md5,))
+            else:
+                if analysis_bytes is not None:
+                    _remove(get_analysis_file(track_md5, touch=False))
+                    freed += analysis_bytes
+                connection.execute('DELETE FROM tracks WHERE md5 = ?', (track_md5,))
+            evicted += 1
+        connection.execute('INSERT OR IGNORE INTO stats VALUES (?, 0)', ('evictions',))
+        connection.execute('UPDATE stats SET count = count + ? WHERE name = ?',
+                           (evicted, 'evictions'))
+        connection.execute('COMMIT')
+    except Exception:
+        connection.execute('ROLLBACK')
+        raise
+    if evicted:
+        LOG.info("Evicted %d tracks (%d bytes) from the local database.", evicted, freed)
+    return freed
 
 def save_to_local(track_md5, audio_file, pyechonest_track):
-    '''Save a track to the db.'''
-    with open(DATABASE, 'a') as db_file:
-        db_file.write(track_md5 + '\n')
+    '''
+    Save a track to the db. Either audio_file or pyechonest_track may be None
+    if only the other one needs to be cached.
+    '''
+    audio_bytes = None
+    analysis_bytes = None
+    if audio_file is not None:
+        audio_bytes = save_audio_to_local(track_md5, audio_file)
+    if pyechonest_track is not None:
+        analysis_bytes = save_analysis_to_local(track_md5, pyechonest_track)
 
-    save_audio_to_local(track_md5, audio_file)
-    save_analysis_to_local(track_md5, pyechonest_track)
+    now = time.time()
+    _transaction(_connect(), [
+        ('INSERT OR IGNORE INTO tracks VALUES (?, NULL, NULL, ?, ?)',
+         (track_md5, now, now)),
+        ('UPDATE tracks SET audio_bytes = COALESCE(?, audio_bytes), '
+         'analysis_bytes = COALESCE(?, analysis_bytes), last_access = ? WHERE md5 = ?',
+         (audio_bytes, analysis_bytes, now, track_md5)),
+    ])
+    if MAX_CACHE_BYTES is not None:
+        evict()
+
+def _atomic_target(target_file):
+    '''Return an open temp file next to target_file, to be renamed over it.'''
+    fd, temp_file = tempfile.mkstemp(suffix='.tmp', dir=os.path.dirname(target_file))
+    return os.fdopen(fd, 'wb'), temp_file
 
 def save_audio_to_local(track_md5, audio_file):
-    '''Copy the uncompressed audio file to the db.'''
-    target_file = AUDIO_FOLDER + os.path.sep + track_md5 + '.wav'
-    shutil.copyfile(audio_file, target_file)
+    '''Copy the uncompressed audio file to the db. Returns its size in bytes.'''
+    target_file = get_audio_file(track_md5, touch=False)
+    handle, temp_file = _atomic_target(target_file)
+    with handle:
+        with open(audio_file, 'rb') as source:
+            shutil.copyfileobj(source, handle)
+    os.rename(temp_file, target_file)
+    return os.path.getsize(target_file)
 
 def save_analysis_to_local(track_md5, pyechonest_track):
-    '''Save the pyechonest track dict as json to the db.'''
-    target_file = ANALYSIS_FOLDER + os.path.sep + track_md5 + '.analysis'
-    with open(target_file, 'wb') as db_file:
-        json.dump(pyechonest_track.__dict__, db_file)
+    '''
+    Save the pyechonest track dict to the db, with the bars, beats, tatums,
+    sections and segments stored as columns (see `load_analysis`). Returns
+    its size in bytes.
+    '''
+    return _write_analysis(track_md5, pyechonest_track.__dict__)
+
+def event_columns(kind, nodes):
+    '''
+    Convert a list of event dicts of the given kind (e.g. 'segments', as
+    returned by the Analyze API) into a dict of columns, keyed by field name.
+    '''
+    columns = {}
+    for field in ('start', 'duration'):
+        columns[field] = numpy.array([n.get(field, numpy.nan) for n in nodes],
+                                     dtype=numpy.float64)
+    for field in ANALYSIS_FIELDS[kind]:
+        if field in VECTOR_FIELDS:
+            column = numpy.array([n[field] for n in nodes], dtype=numpy.float32)
+            column = column.reshape((len(nodes), -1)) if nodes else numpy.zeros((0, 12), numpy.float32)
+        else:
+            column = numpy.array([numpy.nan if n.get(field) is None else n[field] for n in nodes],
+                                 dtype=numpy.float32)
+        columns[field] = column
+    return columns
+
+def _write_analysis(track_md5, track_dict):
+    columns = {}
+    for kind in ANALYSIS_FIELDS:
+        for field, column in event_columns(kind, track_dict.get(kind) or []).items():
+            columns[kind + '.' + field] = column
+    meta = dict((k, v) for k, v in track_dict.items() if k not in ANALYSIS_FIELDS)
+    columns['meta'] = numpy.frombuffer(json.dumps(meta), dtype=numpy.uint8)
+
+    target_file = get_analysis_file(track_md5, touch=False)
+    handle, temp_file = _atomic_target(target_file)
+    with handle:
+        numpy.savez(handle, **columns)
+    os.rename(temp_file, target_file)
+    return os.path.getsize(target_file)
+
+def load_analysis(filename, mmap_mode='r'):
+    '''
+    Load an analysis saved by `save_analysis_to_local`. Returns the track dict
+    without its event lists, and a dict of columns named like
+    'segments.start' or 'segments.pitches' (an N x 12 array).
+
+    The file is an uncompressed .npz, so with `mmap_mode` each column is
+    memory-mapped straight out of the archive instead of being read.
+    '''
+    columns = {}
+    with zipfile.ZipFile(filename) as archive:
+        infos = archive.infolist()
+        if mmap_mode is None or any(i.compress_type != zipfile.ZIP_STORED for i in infos):
+            npz = numpy.load(filename)
+            columns = dict((name, npz[name]) for name in npz.files)
+            npz.close()
+        else:
+            with open(filename, 'rb') as f:
+                for info in infos:
+                    columns[info.filename[:-len('.npy')]] = _map_member(filename, f, info, mmap_mode)
+    meta = json.loads(columns.pop('meta').tostring())
+    return meta, columns
+
+def _map_member(filename, f, info, mmap_mode):
+    '''Memory-map one uncompressed .npy member of a zip archive.'''
+    # Skip the local file header, whose name and extra fields may differ in
+    # length from those in the central directory.
+    f.seek(info.header_offset + 26)
+    name_length, extra_length = struct.unpack('<HH', f.read(4))
+    f.seek(name_length + extra_length, os.SEEK_CUR)
+    version = numpy.lib.format.read_magic(f)
+    if version == (1, 0):
+        shape, fortran_order, dtype = numpy.lib.format.read_array_header_1_0(f)
+    else:
+        shape, fortran_order, dtype = numpy.lib.format.read_array_header_2_0(f)
+    if not numpy.prod(shape):
+        return numpy.zeros(shape, dtype=dtype)
+    return numpy.memmap(filename, dtype=dtype, mode=mmap_mode, offset=f.tell(),
+                        shape=shape, order='F' if fortran_order else 'C')
+
+def _touch(track_md5):
+    '''Mark a track as used now, for least-recently-used eviction.'''
+    counts, access = _queue()
+    access[track_md5] = time.time()
+    _flush(force=False)
 
-def get_audio_file(track_md5):
+def get_audio_file(track_md5, touch=True):
     '''Get an audio file from the db.'''
     target_file = AUDIO_FOLDER + os.path.sep + track_md5 + '.wav'
+    if touch:
+        _touch(track_md5)
     return target_file
 
-def get_analysis_file(track_md5):
+def get_analysis_file(track_md5, touch=True):
     '''Get an analysis file from the db.'''
-    target_file = ANALYSIS_FOLDER + os.path.sep + track_md5 + '.analysis'
+    target_file = ANALYSIS_FOLDER + os.path.sep + track_md5 + '.npz'
+    if touch:
+        _touch(track_md5)
     return target_file
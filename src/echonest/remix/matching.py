@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+matching.py
+
+Nearest-segment matching between two analyses, for resynthesizing one
+track out of the segments of another (see examples/afromb).
+
+Segments are compared by a weighted squared distance between their pitch
+vectors, timbre vectors and starting loudness::
+
+    d(a, b) = pitch * |a.pitches - b.pitches|^2
+            + timbre * |a.timbre - b.timbre|^2
+            + loudness * (a.loudness_begin - b.loudness_begin)^2
+
+which is the squared Euclidean distance between the rows of the matrices
+made by `segment_features`. Matches are found for a block of segments at a
+time with matrix products, or with a KD-tree when scipy is available and
+asked for.
+
+Sample usage::
+
+    indices, distances = matching.match_segments(a.analysis.segments,
+                                                 b.analysis.segments, k=3)
+    best = [b.analysis.segments[i] for i in indices[:, 0]]
+"""
+
+import numpy
+
+try:
+    from scipy.spatial import cKDTree
+except ImportError:
+    cKDTree = None
+
+# Number of query segments compared against all candidates at once. Each
+# block takes BLOCK_SIZE x len(candidates) doubles of scratch space.
+BLOCK_SIZE = 256
+
+
+def _feature(segments, attribute):
+    values = getattr(segments, attribute, None)
+    if values is None or isinstance(values, list):
+        # A plain list of segments, rather than an AudioQuantumList.
+        values = [getattr(s, attribute) for s in segments]
+    return numpy.asarray(values, dtype=numpy.float64)
+
+
+def segment_features(segments, pitch=1.0, timbre=1.0, loudness=1.0):
+    """
+    Returns an N x 25 float64 matrix of the pitches, timbre and
+    `loudness_begin` of `segments` (an `AudioQuantumList` of segments, or any
+    sequence of `AudioSegment`\s), each scaled by the square root of its
+    weight so that squared Euclidean distances between rows are the
+    weighted distances between segments.
+    """
+    n = len(segments)
+    pitches = _feature(segments, 'pitches').reshape((n, -1))
+    timbres = _feature(segments, 'timbre').reshape((n, -1))
+    loudnesses = _feature(segments, 'loudness_begin').reshape((n, 1))
+    return numpy.hstack((pitches * numpy.sqrt(pitch),
+                         timbres * numpy.sqrt(timbre),
+                         loudnesses * numpy.sqrt(loudness)))
+
+
+def nearest(queries, candidates, k=1, tree=False, block_size=BLOCK_SIZE):
+    """
+    Finds the `k` rows of `candidates` closest to each row of `queries`
+    (both 2-D arrays with the same number of columns, as made by
+    `segment_features`). Returns two M x k arrays: the indices of the
+    matches, nearest first, and their Euclidean distances. Equally distant
+    matches come in the order of their indices.
+
+    :param tree: if true, query a scipy KD-tree of `candidates` instead of
+        comparing every pair
+    """
+    queries = numpy.atleast_2d(numpy.asarray(queries, dtype=numpy.float64))
+    candidates = numpy.atleast_2d(numpy.asarray(candidates, dtype=numpy.float64))
+    k = min(k, len(candidates))
+    if k < 1:
+        empty = numpy.zeros((len(queries), 0))
+        return empty.astype(numpy.intp), empty
+    if tree:
+        if cKDTree is None:
+            raise ImportError("KD-tree matching needs scipy.spatial.")
+        distances, indices = cKDTree(candidates).query(queries, k)
+        return indices.reshape((len(queries), k)), distances.reshape((len(queries), k))
+
+    indices = numpy.empty((len(queries), k), dtype=numpy.intp)
+    distances = numpy.empty((len(queries), k), dtype=numpy.float64)
+    norms = numpy.einsum('ij,ij->i', candidates, candidates)
+    for start in xrange(0, len(queries), block_size):
+        block = queries[start:start + block_size]
+        # |q - c|^2 = |q|^2 - 2 q.c + |c|^2, a block at a time.
+        squared = numpy.dot(block, candidates.T)
+        squared *= -2
+        squared += norms
+        squared += numpy.einsum('ij,ij->i', block, block)[:, numpy.newaxis]
+        numpy.maximum(squared, 0, out=squared)
+        rows = numpy.arange(len(block))[:, numpy.newaxis]
+        if k == 1:
+            best = numpy.argmin(squared, axis=1)[:, numpy.newaxis]
+        else:
+            best = numpy.argpartition(squared, k - 1, axis=1)[:, :k]
+            order = numpy.lexsort((best, squared[rows, best]), axis=1)
+            best = best[rows, order]
+        indices[start:start + len(block)] = best
+        distances[start:start + len(block)] = numpy.sqrt(squared[rows, best])
+    return indices, distances
+
+
+def match_segments(segments, candidates, k=1, pitch=1.0, timbre=1.0, loudness=1.0,
+                   tree=False):
+    """
+    For each of `segments`, finds the `k` best matches among the segments
+    `candidates`, weighing pitch, timbre and loudness as given. Returns the
+    M x k arrays of indices into `candidates` and distances of `nearest`.
+    """
+    return nearest(segment_features(segments, pitch, timbre, loudness),
+                   segment_features(candidates, pitch, timbre, loudness),
+                   k=k, tree=tree)
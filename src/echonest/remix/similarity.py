@@ -0,0 +1,208 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+similarity.py
+
+Self-similarity of a track: the Euclidean distances between every pair of
+rows of a feature matrix (such as the timbre or pitches of a track
+resampled to its beats or tatums), or between every pair of windows of
+consecutive rows.
+
+Distances are worked out a tile of BLOCK_SIZE x BLOCK_SIZE pairs at a
+time, so the only full-size array is the float32 result, which can be
+a `numpy.memmap` on disk for very long tracks. `neighbours` keeps just
+the k nearest rows of each, and never holds more than a block of rows
+of the matrix. `loop_points` finds the best jumps in the matrix, for
+looping and extending tracks (see examples/earworm).
+
+Sample usage::
+
+    distances = similarity.self_similarity(timbre, window=16)
+    indices, nearest = similarity.neighbours(timbre, 8, window=16, exclude=16)
+"""
+
+import numpy
+
+# Rows and columns in each tile of distances. A tile and the two blocks
+# of points it compares are a few hundred kilobytes each.
+BLOCK_SIZE = 256
+
+# Squared distances below this fraction of the squared norms of the two
+# points are recomputed from their differences.
+CANCELLATION = 1e-9
+
+
+def embed(features, window=1):
+    """
+    Returns a float64 matrix with a row for each run of `window`
+    consecutive rows of `features` (N - `window` + 1 in all), made of those
+    rows laid end to end. The columns are centred first, which leaves every
+    distance between rows the same but makes the distances more precise.
+    """
+    features = numpy.asarray(features, dtype=numpy.float64)
+    features = features.reshape((len(features), -1))
+    features = features - features.mean(axis=0)
+    count = max(len(features) - window + 1, 0)
+    rows, columns = features.shape
+    strides = (features.strides[0], features.strides[0], features.strides[1])
+    windows = numpy.lib.stride_tricks.as_strided(features, (count, window, columns), strides)
+    return windows.reshape((count, window * columns))
+
+
+def _distances(points, norms, rows, columns):
+    "Distances between the points `rows` and `columns` (two slices) as float32."
+    squared = numpy.dot(points[rows], points[columns].T)
+    squared *= -2
+    scale = norms[rows][:, numpy.newaxis] + norms[columns]
+    squared += scale
+    # Cancellation leaves identical windows a hair apart rather than at
+    # zero; work out the distances of the closest pairs directly.
+    close = squared < CANCELLATION * scale
+    if close.any():
+        r, c = numpy.nonzero(close)
+        difference = points[rows][r] - points[columns][c]
+        squared[r, c] = numpy.einsum('ij,ij->i', difference, difference)
+    numpy.maximum(squared, 0, out=squared)
+    return numpy.sqrt(squared).astype(numpy.float32)
+
+
+def self_similarity(features, window=1, filename=None, out=None, block_size=BLOCK_SIZE):
+    """
+    Returns the N x N float32 matrix of distances between the windows of
+    `window` consecutive rows of `features` (see `embed`). The diagonal is
+    exactly zero.
+
+    :param filename: if given, the matrix is a `numpy.memmap` of this file
+        rather than an array in memory
+    :param out: an N x N float32 array to fill in instead of a new one
+    """
+    points = embed(features, window)
+    n = len(points)
+    if out is None:
+        if filename:
+            out = numpy.memmap(filename, dtype=numpy.float32, mode='w+', shape=(n, n))
+        else:
+            out = numpy.empty((n, n), dtype=numpy.float32)
+    norms = numpy.einsum('ij,ij->i', points, points)
+    # The matrix is symmetric, so each tile above the diagonal fills in its
+    # mirror image below it too.
+    for i in xrange(0, n, block_size):
+        rows = slice(i, min(i + block_size, n))
+        for j in xrange(i, n, block_size):
+            columns = slice(j, min(j + block_size, n))
+            tile = _distances(points, norms, rows, columns)
+            out[rows, columns] = tile
+            if j != i:
+                out[columns, rows] = tile.T
+    out[numpy.arange(n), numpy.arange(n)] = 0
+    if isinstance(out, numpy.memmap):
+        out.flush()
+    return out
+
+
+def neighbours(features, k, window=1, exclude=1, block_size=BLOCK_SIZE):
+    """
+    Finds the `k` nearest windows to each window of `features`, leaving out
+    those less than `exclude` rows away from it (by default, only itself).
+    Returns two N x k arrays: the indices of the neighbours of each, nearest
+    first, and their float32 distances. Rows with fewer than `k` candidates
+    are padded with index -1 and an infinite distance.
+    """
+    points = embed(features, window)
+    n = len(points)
+    indices = numpy.empty((n, k), dtype=numpy.intp)
+    distances = numpy.empty((n, k), dtype=numpy.float32)
+    if k < 1:
+        return indices, distances
+    norms = numpy.einsum('ij,ij->i', points, points)
+    everything = slice(0, n)
+    positions = numpy.arange(n)
+    for i in xrange(0, n, block_size):
+        rows = slice(i, min(i + block_size, n))
+        block = _distances(points, norms, rows, everything)
+        near = numpy.abs(positions[rows][:, numpy.newaxis] - positions) < exclude
+        block[near] = numpy.inf
+        if k < n:
+            best = numpy.argpartition(block, k - 1, axis=1)[:, :k]
+        else:
+            best = numpy.tile(positions, (len(block), 1))
+        line = numpy.arange(len(block))[:, numpy.newaxis]
+        order = numpy.lexsort((best, block[line, best]), axis=1)
+        best = best[line, order]
+        found = block[line, best]
+        best = numpy.where(numpy.isinf(found), -1, best)
+        indices[rows, :best.shape[1]] = best
+        distances[rows, :best.shape[1]] = found
+        indices[rows, best.shape[1]:] = -1
+        distances[rows, best.shape[1]:] = numpy.inf
+    return indices, distances
+
+
+def loop_points(matrix, size=16, max_edges=8, min_range=16, block_size=BLOCK_SIZE):
+    """
+    Finds the best places to jump to from each row of a self-similarity
+    `matrix` (see `self_similarity`): the local minima of the row that are
+    more than one standard deviation below its mean.
+
+    A column is a candidate if it is the minimum of some window of `size`
+    consecutive columns of the row, strictly lower than both of its
+    neighbours, not at either end of the window, and not zero (the
+    diagonal). Candidates less than `min_range` columns apart are
+    clustered, keeping the lowest of each cluster, and the `max_edges`
+    lowest clusters of each row are returned.
+
+    Returns three arrays, one entry per jump: the row it starts from, the
+    column it goes to, and its distance, ordered by row and then by
+    distance.
+    """
+    matrix = numpy.asarray(matrix)
+    if matrix.ndim == 1:
+        matrix = matrix[numpy.newaxis]
+    n, length = matrix.shape
+    count = length - size
+    found = []
+    if count > 0 and size > 2:
+        starts = numpy.arange(count)
+        for i in xrange(0, n, block_size):
+            block = numpy.ascontiguousarray(matrix[i:i + block_size])
+            # Every window of `size` columns of every row, as a view.
+            windows = numpy.lib.stride_tricks.as_strided(
+                block, (len(block), count, size),
+                (block.strides[0], block.strides[1], block.strides[1]))
+            offsets = windows.argmin(axis=2)
+            columns = starts + offsets
+            line = numpy.arange(len(block))[:, numpy.newaxis]
+            values = block[line, columns]
+            interior = (offsets != 0) & (offsets != size - 1)
+            # Clipped, as the end of the window is never a candidate anyway.
+            before = block[line, numpy.maximum(columns - 1, 0)]
+            after = block[line, numpy.minimum(columns + 1, length - 1)]
+            threshold = (block.mean(axis=1) - block.std(axis=1))[:, numpy.newaxis]
+            keep = interior & (values < before) & (values < after) & \
+                   (values < threshold) & (values != 0)
+            rows, windows_kept = numpy.nonzero(keep)
+            found.append((rows + i, columns[rows, windows_kept]))
+    rows = numpy.concatenate([r for r, c in found] or [numpy.zeros(0, dtype=numpy.intp)])
+    columns = numpy.concatenate([c for r, c in found] or [numpy.zeros(0, dtype=numpy.intp)])
+    if not len(rows):
+        return rows, columns, numpy.zeros(0, dtype=matrix.dtype)
+    # The same minimum is found by every window it is the minimum of.
+    flat = numpy.unique(rows * length + columns)
+    rows, columns = flat // length, flat % length
+    values = matrix[rows, columns]
+
+    # Clusters are runs of candidates, in a row, with gaps under min_range.
+    gaps = numpy.diff(columns) >= min_range
+    fresh = numpy.concatenate(([True], gaps | (numpy.diff(rows) != 0)))
+    cluster = numpy.cumsum(fresh)
+    order = numpy.lexsort((columns, values, cluster))
+    lowest = order[numpy.concatenate(([True], numpy.diff(cluster[order]) != 0))]
+    rows, columns, values = rows[lowest], columns[lowest], values[lowest]
+
+    # The best max_edges of each row.
+    order = numpy.lexsort((columns, values, rows))
+    rows, columns, values = rows[order], columns[order], values[order]
+    first = numpy.concatenate(([0], numpy.nonzero(numpy.diff(rows))[0] + 1))
+    rank = numpy.arange(len(rows)) - numpy.repeat(first, numpy.diff(numpy.append(first, len(rows))))
+    best = rank < max_edges
+    return rows[best], columns[best], values[best]
@@ -1 +1 @@
-__all__ = [ 'midi', 'ffmpeg' ]
+__all__ = [ 'midi', 'ffmpeg', 'instrument' ]
@@ -7,12 +7,17 @@ import tempfile
 import subprocess
 import cStringIO
 from exceptionthread import ExceptionThread
+import instrument
 
 log = logging.getLogger(__name__)
 
 # Base name of the ffmpeg binary. Can be monkey-patched if desired.
 FFMPEG = 'en-ffmpeg'
 
+# Number of sample frames in each block that AudioData.encode hands to
+# ffmpeg_encode.
+STREAM_BLOCK_SIZE = 65536
+
 def get_os():
     """returns is_linux, is_mac, is_windows"""
     if hasattr(os, 'uname'):
@@ -120,12 +125,95 @@ def ffmpeg(infile, outfile=None, overwrite=True, bitRate=None,
     ffmpeg_error_check(e)
     mid = time.time()
     log.info("Decoded in %ss.", (mid - start))
+    instrument.record('decode', start, bytes=len(f), peak=(0 if outfile else len(f)),
+                      file=filename, outfile=outfile)
     if outfile:
         return settings_from_ffmpeg(e)
     else:
         return numpy.frombuffer(f, dtype=numpy.int16).reshape((-1, 2))
 
 
+def ffmpeg_encode(blocks, outfile, inSampleRate=44100, inChannels=2, overwrite=True,
+                  bitRate=None, numChannels=None, sampleRate=None, verbose=True):
+    """
+    Encodes raw PCM to `outfile` by piping it into ffmpeg's stdin, so that no
+    intermediate WAV file is ever written and encoding starts as soon as the
+    first block arrives.
+
+    `blocks` is an iterable (typically a generator) of int16 ndarrays of
+    interleaved samples at `inSampleRate` with `inChannels` channels. The
+    other arguments are those of `ffmpeg`, and like `ffmpeg` this returns
+    the sampling frequency and number of channels that ffmpeg reports.
+    """
+    start = time.time()
+    command = [FFMPEG, "-f", "s16le", "-ar", str(inSampleRate),
+               "-ac", str(inChannels), "-i", "pipe:0"]
+
+    if overwrite:
+        command.append("-y")
+
+    if bitRate is not None:
+        command.extend(("-ab", str(bitRate) + "k"))
+
+    command.extend(("-ac", str(numChannels or 2), "-ar", str(sampleRate or 44100), outfile))
+    if verbose:
+        log.info(command)
+
+    (lin, mac, win) = get_os()
+    # Only a file that ffmpeg may have created is removed if encoding fails.
+    existed = os.path.exists(outfile) and not overwrite
+    devnull = open(os.devnull, 'wb')
+    p = subprocess.Popen(
+            command,
+            shell=False,
+            stdin=subprocess.PIPE,
+            stdout=devnull,
+            stderr=subprocess.PIPE,
+            close_fds=(not win)
+    )
+
+    stderr = []
+    reader = ExceptionThread(target=lambda: stderr.append(p.stderr.read()))
+    reader.start()
+    moved = 0
+    peak = 0
+    finished = False
+    try:
+        try:
+            for block in blocks:
+                block = numpy.ascontiguousarray(block, dtype='<i2')
+                moved += block.nbytes
+                peak = max(peak, block.nbytes)
+                p.stdin.write(block.data)
+        except IOError:
+            # ffmpeg exited before taking all of its input; stderr says why.
+            pass
+        finished = True
+    finally:
+        if not finished:
+            # Producing the blocks failed; stop ffmpeg, and remove the
+            # truncated file below.
+            try:
+                p.kill()
+            except OSError:
+                pass
+        try:
+            p.stdin.close()
+        except IOError:
+            pass
+        p.wait()
+        reader.join()
+        devnull.close()
+        if not finished and not existed and os.path.exists(outfile):
+            os.unlink(outfile)
+
+    e = stderr[0]
+    ffmpeg_error_check(e)
+    log.info("Encoded in %ss.", (time.time() - start))
+    instrument.record('encode', start, bytes=moved, peak=peak, file=outfile)
+    return settings_from_ffmpeg(e)
+
+
 def ffmpeg_downconvert(infile, lastTry=False):
     """
     Downconvert the given filename (or file-like) object to 32kbps MP3 for analysis.
@@ -177,6 +265,7 @@ def ffmpeg_downconvert(infile, lastTry=False):
     bytesize = io.tell()
     io.seek(0)
     log.info("Transcoded to 32kbps mp3 in %ss. Final size: %s bytes.", (end - start), bytesize)
+    instrument.record('downconvert', start, bytes=bytesize, file=filename)
     return io
 
 
@@ -206,6 +295,28 @@ Alternatively, import echonest.remix.support.ffmpeg and modify ffmpeg.FFMPEG to
 the appropriate binary.
 """
 
+class FFMPEGError(RuntimeError):
+    """
+    Raised by `ffmpeg_error_check` for errors in the ffmpeg output.
+    `transient` is True when the same conversion may well succeed if it
+    is simply run again.
+    """
+    def __init__(self, message, transient=False):
+        RuntimeError.__init__(self, message)
+        self.transient = transient
+
+# Errors caused by the state of the machine rather than by the input file.
+# Only OS-level I/O and resource messages: ffmpeg's generic messages (such
+# as "error occurred") also come with corrupt or unsupported input.
+transient_cases = ["Resource temporarily unavailable",  # out of processes (EAGAIN)
+                   "Cannot allocate memory",            # out of memory (ENOMEM)
+                   "Too many open files",               # out of file handles (EMFILE)
+                   "Interrupted system call",           # a signal interrupted a read or write (EINTR)
+                   "Input/output error",                # the disk or network share failed (EIO)
+                   "Connection reset by peer",          # a network input dropped (ECONNRESET)
+                   "Connection timed out",              # a network input stalled (ETIMEDOUT)
+                    ]
+
 def ffmpeg_error_check(parsestring):
     "Looks for known errors in the ffmpeg output"
     parse = parsestring.split('\n')
@@ -218,8 +329,9 @@ def ffmpeg_error_check(parsestring):
                     ]
     for num, line in enumerate(parse):
         if "command not found" in line or FFMPEG+": not found" in line:
-            raise RuntimeError(ffmpeg_install_instructions)
+            raise FFMPEGError(ffmpeg_install_instructions)
         for error in error_cases:
             if error in line:
                 report = "\n\t".join(parse[num:])
-                raise RuntimeError("ffmpeg conversion error:\n\t" + report)
+                transient = any(case in report for case in transient_cases)
+                raise FFMPEGError("ffmpeg conversion error:\n\t" + report, transient)
@@ -0,0 +1,166 @@
+"""
+Per-stage timing and memory instrumentation.
+
+Decoding, analysis, parsing, rendering and encoding each record an `Event`
+with their wall time, the bytes they moved and the size of the largest
+array they allocated. Recording is off unless `enable`\() is called or the
+REMIX_INSTRUMENT environment variable is set::
+
+    from echonest.remix.support import instrument
+    instrument.enable()
+    ... remix ...
+    print instrument.summary()
+    instrument.chrome_trace('trace.json')   # open in chrome://tracing
+
+Events are kept per process, so a `batch` worker sees only its own.
+"""
+import os
+import json
+import time
+import threading
+
+# Can be monkey-patched, or set with the REMIX_INSTRUMENT environment variable.
+ENABLED = bool(os.environ.get('REMIX_INSTRUMENT'))
+
+_events = []
+
+
+class Event(object):
+    """
+    One call of a stage: its `name`, `start` (as from `time.time`\()) and
+    `elapsed` seconds, the `bytes` it moved, the `peak` size in bytes of the
+    largest array it allocated, and any other details in `args`.
+    """
+    __slots__ = ('name', 'start', 'elapsed', 'bytes', 'peak', 'pid', 'tid', 'args')
+
+    def __init__(self, name, start, elapsed, bytes=0, peak=0, args=None):
+        self.name = name
+        self.start = start
+        self.elapsed = elapsed
+        self.bytes = bytes
+        self.peak = peak
+        self.pid = os.getpid()
+        self.tid = threading.current_thread().ident
+        self.args = args or {}
+
+    def todict(self):
+        return {'name': self.name, 'start': self.start, 'elapsed': self.elapsed,
+                'bytes': self.bytes, 'peak': self.peak, 'pid': self.pid,
+                'tid': self.tid, 'args': self.args}
+
+
+class stage(object):
+    """
+    Records the code it wraps as one call of the stage `name`; keyword
+    arguments are kept in the event's `args`::
+
+        with instrument.stage('render', kind='bars') as s:
+            out = numpy.zeros(n)
+            s.array(out)
+
+    Does nothing but time the block when recording is off.
+    """
+    def __init__(self, name, **args):
+        self.name = name
+        self.args = args
+        self.bytes = 0
+        self.peak = 0
+
+    def moved(self, nbytes):
+        "Counts `nbytes` more bytes read or written by the stage."
+        self.bytes += nbytes
+
+    def array(self, ndarray):
+        "Notes an array allocated by the stage, for its peak."
+        self.peak = max(self.peak, ndarray.nbytes)
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if exc_type is not None:
+            self.args['error'] = exc_type.__name__
+        record(self.name, self.start, self.bytes, self.peak, **self.args)
+        return False
+
+
+def record(name, start, bytes=0, peak=0, **args):
+    """
+    Records a call of the stage `name` that began at `start` (from
+    `time.time`\()) and has just finished. Returns the `Event`, or None
+    if recording is off.
+    """
+    if not ENABLED:
+        return None
+    event = Event(name, start, time.time() - start, bytes, peak, args)
+    _events.append(event)
+    return event
+
+
+def enable():
+    global ENABLED
+    ENABLED = True
+
+
+def disable():
+    global ENABLED
+    ENABLED = False
+
+
+def reset():
+    "Forgets every recorded event."
+    del _events[:]
+
+
+def events(name=None):
+    "Returns the recorded events, or only those of the stage `name`."
+    return [e for e in _events if name is None or e.name == name]
+
+
+def summary():
+    """
+    Returns a dict of the totals for each stage, by name: the number of
+    `calls`, the total and longest `seconds`, the `bytes` moved and the
+    `peak` array size.
+    """
+    stages = {}
+    for e in _events:
+        s = stages.setdefault(e.name, {'calls': 0, 'seconds': 0.0, 'max_seconds': 0.0,
+                                       'bytes': 0, 'peak': 0})
+        s['calls'] += 1
+        s['seconds'] += e.elapsed
+        s['max_seconds'] = max(s['max_seconds'], e.elapsed)
+        s['bytes'] += e.bytes
+        s['peak'] = max(s['peak'], e.peak)
+    return stages
+
+
+def metrics(filename=None):
+    """
+    Returns the `summary` and every event as a JSON-friendly dict, and
+    writes it to `filename` as JSON if given.
+    """
+    out = {'stages': summary(), 'events': [e.todict() for e in _events]}
+    if filename:
+        with open(filename, 'w') as f:
+            json.dump(out, f, indent=1)
+    return out
+
+
+def chrome_trace(filename=None):
+    """
+    Returns the events in the Trace Event Format read by chrome://tracing
+    and Perfetto, and writes them to `filename` as JSON if given.
+    """
+    trace = []
+    for e in _events:
+        args = dict(e.args, bytes=e.bytes, peak=e.peak)
+        trace.append({'name': e.name, 'cat': 'remix', 'ph': 'X',
+                      'ts': int(e.start * 1e6), 'dur': int(e.elapsed * 1e6),
+                      'pid': e.pid, 'tid': e.tid, 'args': args})
+    out = {'traceEvents': trace, 'displayTimeUnit': 'ms'}
+    if filename:
+        with open(filename, 'w') as f:
+            json.dump(out, f)
+    return out
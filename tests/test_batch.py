@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Test running remix functions over a pool of workers with `batch.run`.
+
+Run the tests like this:
+    python test_batch.py
+"""
+
+import os
+import time
+import errno
+import signal
+import unittest
+
+from echonest.remix import batch
+from echonest.remix.support.ffmpeg import ffmpeg_error_check, FFMPEGError
+
+def double(x):
+    return 2 * x
+
+def fail(x):
+    raise ValueError(x)
+
+def sleep_swallowing_errors(seconds):
+    """A job that catches every Exception, as remix code sometimes does."""
+    try:
+        time.sleep(seconds)
+    except Exception:
+        pass
+    return seconds
+
+def sleep_swallowing_everything(seconds):
+    """A job that even catches the alarm, with a bare except."""
+    end = time.time() + seconds
+    while time.time() < end:
+        try:
+            time.sleep(end - time.time())
+        except:
+            pass
+    return seconds
+
+def die(x):
+    """Kills its worker, as the OOM killer or a segfault would."""
+    if x == 'die':
+        os.kill(os.getpid(), signal.SIGKILL)
+    return x
+
+_tries = {}
+
+def flaky(x):
+    """Fails with a transient error the first time it is called in a worker."""
+    _tries[x] = _tries.get(x, 0) + 1
+    if _tries[x] == 1:
+        raise OSError(errno.EAGAIN, "Try again")
+    return x
+
+class BatchTest(unittest.TestCase):
+    def run_all(self, remix, inputs, **kwargs):
+        return sorted(batch.run(remix, inputs, processes=2, **kwargs))
+
+    def test_values(self):
+        results = self.run_all(double, range(5))
+        self.assertEqual([r.value for r in results], [0, 2, 4, 6, 8])
+        self.assertEqual([r.input for r in results], range(5))
+        self.assertTrue(all(r.error is None and r.attempts == 1 for r in results))
+
+    def test_error(self):
+        result, = self.run_all(fail, ['bad'])
+        self.assertEqual(result.value, None)
+        self.assertTrue('ValueError: bad' in result.error)
+        self.assertEqual(result.attempts, 1)
+
+    def test_transient_retry(self):
+        batch.RETRY_DELAY, delay = 0, batch.RETRY_DELAY
+        try:
+            result, = self.run_all(flaky, [7])
+        finally:
+            batch.RETRY_DELAY = delay
+        self.assertEqual((result.value, result.error, result.attempts), (7, None, 2))
+
+    def test_timeout_not_swallowed(self):
+        started = time.time()
+        result, = self.run_all(sleep_swallowing_errors, [3], timeout=1)
+        self.assertTrue(time.time() - started < 2.5)
+        self.assertEqual(result.value, None)
+        self.assertTrue(result.error.startswith("Timed out"))
+
+    def test_timeout_overrun(self):
+        result, = self.run_all(sleep_swallowing_everything, [1.5], timeout=1)
+        self.assertEqual(result.value, None)
+        self.assertTrue(result.error.startswith("Timed out"))
+
+    def test_is_transient(self):
+        def error(output):
+            try:
+                ffmpeg_error_check(output)
+            except FFMPEGError, e:
+                return e
+        corrupt = error("x.mp3: Invalid data found when processing input\nan error occurred")
+        busy = error("Could not open 'x.mp3': Resource temporarily unavailable")
+        self.assertFalse(batch.is_transient(corrupt))
+        self.assertTrue(batch.is_transient(busy))
+        self.assertTrue(batch.is_transient(OSError(errno.EAGAIN, "Try again")))
+        self.assertFalse(batch.is_transient(OSError(errno.ENOENT, "No such file")))
+        self.assertFalse(batch.is_transient(ValueError()))
+
+    def test_worker_killed(self):
+        batch.TIMEOUT_MARGIN, margin = 1, batch.TIMEOUT_MARGIN
+        started = time.time()
+        try:
+            results = self.run_all(die, ['a', 'die', 'b'], timeout=1)
+        finally:
+            batch.TIMEOUT_MARGIN = margin
+        self.assertTrue(time.time() - started < 10)
+        self.assertEqual([(r.input, r.value) for r in results],
+                         [('a', 'a'), ('die', None), ('b', 'b')])
+        self.assertTrue(results[1].error.startswith("TimeoutError"))
+
+if __name__ == '__main__':
+    unittest.main()
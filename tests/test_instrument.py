@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Test the per-stage instrumentation in `support.instrument`.
+
+Run the tests like this:
+    python test_instrument.py
+"""
+
+import os
+import json
+import tempfile
+import unittest
+
+import numpy
+
+from echonest.remix.support import instrument
+
+class InstrumentTest(unittest.TestCase):
+    def setUp(self):
+        self.enabled = instrument.ENABLED
+        instrument.reset()
+
+    def tearDown(self):
+        instrument.ENABLED = self.enabled
+        instrument.reset()
+
+    def test_disabled_records_nothing(self):
+        instrument.disable()
+        with instrument.stage('render') as s:
+            s.moved(10)
+        self.assertEqual(instrument.events(), [])
+
+    def test_stage(self):
+        instrument.enable()
+        with instrument.stage('render', kind='bars') as s:
+            s.moved(100)
+            s.moved(28)
+            s.array(numpy.zeros(1000, dtype=numpy.int16))
+            s.array(numpy.zeros(10))
+        event, = instrument.events('render')
+        self.assertEqual((event.bytes, event.peak), (128, 2000))
+        self.assertEqual(event.args, {'kind': 'bars'})
+        self.assertTrue(event.elapsed >= 0)
+
+    def test_error_recorded(self):
+        instrument.enable()
+        def fail():
+            with instrument.stage('decode'):
+                raise IOError()
+        self.assertRaises(IOError, fail)
+        self.assertEqual(instrument.events('decode')[0].args['error'], 'IOError')
+
+    def test_summary_and_files(self):
+        instrument.enable()
+        for nbytes in (10, 30):
+            instrument.record('encode', 0, bytes=nbytes, peak=nbytes)
+        instrument.record('parse', 0)
+        summary = instrument.summary()
+        self.assertEqual(summary['encode']['calls'], 2)
+        self.assertEqual((summary['encode']['bytes'], summary['encode']['peak']), (40, 30))
+        fd, name = tempfile.mkstemp('.json')
+        os.close(fd)
+        try:
+            instrument.chrome_trace(name)
+            with open(name) as f:
+                trace = json.load(f)['traceEvents']
+            self.assertEqual([e['name'] for e in trace], ['encode', 'encode', 'parse'])
+            self.assertEqual(trace[1]['args']['bytes'], 30)
+            instrument.metrics(name)
+            with open(name) as f:
+                self.assertEqual(len(json.load(f)['events']), 3)
+        finally:
+            os.unlink(name)
+
+if __name__ == '__main__':
+    unittest.main()
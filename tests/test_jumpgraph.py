@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Test the jump graph used by earworm to lengthen, shorten and loop tracks.
+
+Run the tests like this:
+    python test_jumpgraph.py
+"""
+
+import os
+import tempfile
+import unittest
+
+import numpy
+
+from echonest.remix.jumpgraph import JumpGraph
+
+def make_graph(n=400, period=32, seed=0):
+    """
+    Half-second beats of a track that repeats every `period` beats, with a
+    jump from each beat to the same beat in the other repeats.
+    """
+    random = numpy.random.RandomState(seed)
+    paths = []
+    for i in xrange(n):
+        paths.append([(j - 1, random.uniform(1, 10)) for j in xrange(i % period, n, period)
+                      if j != i and 0 < j])
+    return JumpGraph.from_paths(numpy.arange(n) * 0.5, numpy.ones(n) * 0.5, paths)
+
+class JumpGraphTest(unittest.TestCase):
+    def setUp(self):
+        self.graph = make_graph()
+
+    def test_structure(self):
+        graph = self.graph
+        self.assertEqual(len(graph), 400)
+        self.assertTrue((graph.targets != graph.sources + 1).all())
+        for u in (0, 17, 399):
+            jumps = graph.jumps_from(u)
+            self.assertTrue((graph.sources[jumps] == u).all())
+            self.assertTrue((numpy.diff(graph.costs[jumps]) >= 0).all())
+        self.assertEqual(graph.indptr[-1], len(graph.targets))
+
+    def test_jumps_and_gains(self):
+        graph = self.graph
+        backward = graph.jumps('backward')
+        gains = graph.gains(backward)
+        self.assertTrue((graph.targets[backward] < graph.sources[backward]).all())
+        self.assertTrue((gains > 0).all() and (numpy.diff(gains) <= 0).all())
+        forward = graph.jumps('forward')
+        self.assertTrue((graph.gains(forward) < 0).all())
+        self.assertEqual(len(backward) + len(forward), len(graph.targets))
+
+    def test_pruned(self):
+        pruned = self.graph.pruned(64)
+        distance = pruned.targets - pruned.sources
+        self.assertTrue(((distance > 64) | (distance <= -63)).all())
+        self.assertTrue(0 < len(pruned.targets) < len(self.graph.targets))
+
+    def test_path_durations(self):
+        graph = self.graph
+        last = len(graph) - 1
+        span = graph.starts[last]
+        for target in (20, 100, span, 500, 3600):
+            jumps = graph.path(target)
+            duration = graph.duration(0, jumps, last)
+            # Within a period of the target, the smallest jump there is.
+            self.assertTrue(abs(duration - target) <= 16, (target, duration))
+            sources = graph.sources[jumps]
+            self.assertTrue((numpy.diff(sources) >= 0).all())
+        self.assertEqual(graph.path(span), [])
+
+    def test_shortest_path(self):
+        graph = self.graph
+        jumps = graph.shortest_path(0, len(graph) - 1)
+        self.assertTrue(len(jumps) > 0)
+        self.assertEqual(graph.path(0), jumps)
+        self.assertEqual(graph.shortest_path(10, 5, 0, 20, backward=True), None)
+        back = graph.shortest_path(10, 5, backward=True)
+        self.assertTrue((graph.targets[back] < graph.sources[back]).all())
+
+    def test_loop(self):
+        graph = self.graph
+        for target in (60, 300):
+            first, jumps = graph.loop(target)
+            # Play on from `first` taking the jumps, ending with one back to it.
+            self.assertEqual(graph.targets[jumps[-1]], first)
+            position = first
+            for jump in jumps:
+                self.assertTrue(position <= graph.sources[jump])
+                position = graph.targets[jump]
+            duration = graph.duration(first, jumps, first)
+            self.assertTrue(abs(duration - target) <= 16, (target, duration))
+
+    def test_loop_trims_ends_without_jumps_back(self):
+        paths = [[] for i in xrange(100)]
+        paths[80] = [(19, 1.0)]
+        paths[90] = [(29, 1.0)]
+        graph = JumpGraph.from_paths(numpy.arange(100.), numpy.ones(100), paths)
+        first, jumps = graph.loop(0)
+        self.assertEqual(first, 20)
+        self.assertEqual(graph.targets[jumps[-1]], 20)
+        self.assertEqual(JumpGraph(numpy.arange(10.), numpy.ones(10)).loop(10), None)
+
+    def test_save_and_load(self):
+        fd, name = tempfile.mkstemp('.npz')
+        os.close(fd)
+        try:
+            self.graph.save(name)
+            loaded = JumpGraph.load(name)
+        finally:
+            os.unlink(name)
+        for attribute in ('starts', 'durations', 'sources', 'targets', 'costs', 'indptr'):
+            numpy.testing.assert_array_equal(getattr(loaded, attribute),
+                                             getattr(self.graph, attribute))
+
+if __name__ == '__main__':
+    unittest.main()
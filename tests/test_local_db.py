@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Test the local cache's index and least-recently-used eviction, in a
+temporary folder rather than ~/.remix-db.
+
+Run the tests like this:
+    python test_local_db.py
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from echonest.remix import local_db
+
+class EvictionTest(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.saved = dict((name, getattr(local_db, name)) for name in
+                          ('AUDIO_FOLDER', 'ANALYSIS_FOLDER', 'DATABASE', 'INDEX',
+                           'MAX_CACHE_BYTES', 'STATS_FLUSH_INTERVAL', '_connection'))
+        local_db.AUDIO_FOLDER = os.path.join(self.folder, 'audio')
+        local_db.ANALYSIS_FOLDER = os.path.join(self.folder, 'analysis')
+        local_db.DATABASE = os.path.join(self.folder, 'database.db')
+        local_db.INDEX = os.path.join(self.folder, 'index.sqlite')
+        local_db.MAX_CACHE_BYTES = None
+        local_db._connection = None
+        local_db._pending_pid = None
+        local_db.check_and_create_local_db()
+
+    def tearDown(self):
+        local_db._flush()
+        local_db._connect().close()
+        for name, value in self.saved.items():
+            setattr(local_db, name, value)
+        shutil.rmtree(self.folder)
+
+    def add_track(self, track_md5, audio_bytes, analysis_bytes, last_access):
+        """Index a track with files of the given sizes, used at last_access."""
+        for target_file, size in ((local_db.get_audio_file(track_md5, touch=False), audio_bytes),
+                                  (local_db.get_analysis_file(track_md5, touch=False), analysis_bytes)):
+            with open(target_file, 'wb') as f:
+                f.write('x' * size)
+        local_db._transaction(local_db._connect(), [
+            ('INSERT INTO tracks VALUES (?, ?, ?, ?, ?)',
+             (track_md5, audio_bytes, analysis_bytes, last_access, last_access))])
+
+    def test_least_recently_used_first(self):
+        self.add_track('old', 500, 100, 1.0)
+        self.add_track('new', 500, 100, 2.0)
+        self.assertEqual(local_db.evict(max_bytes=700), 600)
+        self.assertFalse(local_db.check_db('old'))
+        self.assertTrue(local_db.check_db('new'))
+        self.assertFalse(os.path.exists(local_db.get_audio_file('old', touch=False)))
+        stats = local_db.cache_stats()
+        self.assertEqual((stats['tracks'], stats['evictions']), (1, 1))
+
+    def test_keep_analysis(self):
+        self.add_track('old', 500, 100, 1.0)
+        self.add_track('new', 500, 100, 2.0)
+        self.assertEqual(local_db.evict(max_bytes=1000, keep_analysis=True), 500)
+        self.assertTrue(os.path.exists(local_db.get_analysis_file('old', touch=False)))
+        stats = local_db.cache_stats()
+        self.assertEqual((stats['tracks'], stats['audio_bytes'], stats['evictions']),
+                         (2, 500, 1))
+
+    def test_keep_analysis_only_analyses_left(self):
+        """Nothing is evicted, or counted, once only analyses are left."""
+        self.add_track('old', 500, 600, 1.0)
+        self.add_track('new', 500, 600, 2.0)
+        self.assertEqual(local_db.evict(max_bytes=1000, keep_analysis=True), 1000)
+        self.assertEqual(local_db.evict(max_bytes=1000, keep_analysis=True), 0)
+        self.assertEqual(local_db.evict(max_bytes=1000, keep_analysis=True), 0)
+        stats = local_db.cache_stats()
+        self.assertEqual((stats['tracks'], stats['audio_bytes'], stats['evictions']),
+                         (2, 0, 2))
+
+    def test_lookups_are_batched(self):
+        local_db.STATS_FLUSH_INTERVAL = 3600
+        self.add_track('cached', 500, 100, 1.0)
+        local_db._flush()
+        connection = local_db._connect()
+        changes = connection.total_changes
+        for i in xrange(5):
+            self.assertTrue(local_db.has_audio('cached'))
+            self.assertFalse(local_db.has_analysis('missing'))
+            local_db.get_analysis_file('cached')
+        self.assertEqual(connection.total_changes, changes)
+        stats = local_db.cache_stats()
+        self.assertEqual((stats['audio_hits'], stats['analysis_misses']), (5, 5))
+        last_access, = connection.execute('SELECT last_access FROM tracks WHERE md5 = ?',
+                                          ('cached',)).fetchone()
+        self.assertTrue(last_access > 1.0)
+
+    def test_pending_touches_order_eviction(self):
+        local_db.STATS_FLUSH_INTERVAL = 3600
+        self.add_track('old', 500, 100, 1.0)
+        self.add_track('new', 500, 100, 2.0)
+        local_db.get_audio_file('old')
+        self.assertEqual(local_db.evict(max_bytes=700), 600)
+        self.assertTrue(local_db.check_db('old'))
+        self.assertFalse(local_db.check_db('new'))
+
+if __name__ == '__main__':
+    unittest.main()
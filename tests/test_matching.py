@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Test the blocked nearest-segment search of `matching` against comparing
+every pair of segments.
+
+Run the tests like this:
+    python test_matching.py
+"""
+
+import unittest
+
+import numpy
+
+from echonest.remix import matching
+
+class Segment(object):
+    def __init__(self, random):
+        self.pitches = list(random.rand(12))
+        self.timbre = list(random.randn(12) * 40)
+        self.loudness_begin = random.uniform(-60, 0)
+
+def distance(a, b, pitch=1.0, timbre=1.0, loudness=1.0):
+    """The weighted distance that afromb used to work out for each pair."""
+    return (pitch * sum((x - y) ** 2 for x, y in zip(a.pitches, b.pitches)) +
+            timbre * sum((x - y) ** 2 for x, y in zip(a.timbre, b.timbre)) +
+            loudness * (a.loudness_begin - b.loudness_begin) ** 2)
+
+class MatchingTest(unittest.TestCase):
+    def setUp(self):
+        random = numpy.random.RandomState(0)
+        self.a = [Segment(random) for i in xrange(70)]
+        self.b = [Segment(random) for i in xrange(50)]
+
+    def expected(self, k, **weights):
+        squared = numpy.array([[distance(a, b, **weights) for b in self.b] for a in self.a])
+        indices = numpy.argsort(squared, axis=1, kind='mergesort')[:, :k]
+        return indices, numpy.sqrt(numpy.sort(squared, axis=1)[:, :k])
+
+    def test_nearest(self):
+        for k in (1, 3):
+            indices, distances = matching.nearest(matching.segment_features(self.a),
+                                                  matching.segment_features(self.b),
+                                                  k=k, block_size=16)
+            expected_indices, expected_distances = self.expected(k)
+            numpy.testing.assert_array_equal(indices, expected_indices)
+            numpy.testing.assert_allclose(distances, expected_distances, rtol=1e-6)
+
+    def test_weights(self):
+        indices, distances = matching.match_segments(self.a, self.b, k=2, pitch=10,
+                                                     timbre=0.01, loudness=0)
+        expected_indices, expected_distances = self.expected(2, pitch=10, timbre=0.01, loudness=0)
+        numpy.testing.assert_array_equal(indices, expected_indices)
+        numpy.testing.assert_allclose(distances, expected_distances, rtol=1e-6)
+
+    def test_more_than_candidates(self):
+        self.b = self.b[:2]
+        indices, distances = matching.match_segments(self.a, self.b, k=4)
+        self.assertEqual(indices.shape, (70, 2))
+        numpy.testing.assert_array_equal(indices, self.expected(2)[0])
+
+    def test_tree(self):
+        if matching.cKDTree is None:
+            return
+        indices, distances = matching.match_segments(self.a, self.b, k=3, tree=True)
+        numpy.testing.assert_array_equal(indices, self.expected(3)[0])
+
+if __name__ == '__main__':
+    unittest.main()
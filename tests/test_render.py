@@ -0,0 +1,198 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Test rendering `AudioQuantumList`s and other renderables through render
+plans, against the samples put together by hand.
+
+Run the tests like this:
+    python test_render.py
+"""
+
+import unittest
+
+import numpy
+
+from echonest.remix import audio
+
+def source(seed, seconds=4):
+    random = numpy.random.RandomState(seed)
+    data = random.randint(-3000, 3000, (44100 * seconds, 2)).astype(numpy.int16)
+    return audio.AudioData(ndarray=data, sampleRate=44100, numChannels=2, verbose=False)
+
+def quantum(source, start, duration=0.5):
+    aq = audio.AudioQuantum(start, duration, kind='beat')
+    aq.source = source
+    return aq
+
+def piece(aq):
+    "The samples of `aq`, as `AudioQuantum.render` slices them."
+    first = int(float(aq.start) * aq.source.sampleRate)
+    last = int((aq.start + aq.duration) * aq.source.sampleRate)
+    return aq.source.data[first:last].astype(numpy.int32)
+
+def assemble(quanta):
+    """
+    The quanta one after another, each at the sample its start time falls on,
+    in a buffer at least as long as their durations add up to.
+    """
+    length = sum(int(aq.duration * 44100) for aq in quanta)
+    out = numpy.zeros((length, 2), dtype=numpy.int32)
+    start = 0.0
+    for aq in quanta:
+        offset = int(start * 44100)
+        samples = piece(aq)
+        if len(out) < offset + len(samples):
+            out = numpy.concatenate((out, numpy.zeros((offset + len(samples) - len(out), 2),
+                                                      dtype=numpy.int32)))
+        out[offset:offset + len(samples)] += samples
+        start += aq.duration
+    return out
+
+class Unfolded(object):
+    "Wraps an effect without its `fold`, so it is applied by `modify` alone."
+    def __init__(self, effect):
+        self.effect = effect
+
+    def duration(self, old_duration):
+        if hasattr(self.effect, 'duration'):
+            return self.effect.duration(old_duration)
+        return old_duration
+
+    def modify(self, adata):
+        return self.effect.modify(adata)
+
+class RenderTest(unittest.TestCase):
+    def setUp(self):
+        self.a = source(0)
+        self.b = source(1)
+
+    def assertRenders(self, renderable, expected):
+        out = renderable.render()
+        self.assertTrue(isinstance(out, audio.AudioData32))
+        self.assertEqual(out.data.dtype, numpy.int32)
+        numpy.testing.assert_array_equal(out.data, expected)
+        return out
+
+    def test_quantum(self):
+        out = quantum(self.a, 0.5).render()
+        self.assertEqual(type(out), audio.AudioData)
+        self.assertEqual(out.data.dtype, numpy.int16)
+        numpy.testing.assert_array_equal(out.data, piece(quantum(self.a, 0.5)))
+
+    def test_reversed_beats(self):
+        beats = [quantum(self.a, 0.25 * i, 0.25) for i in xrange(12)]
+        beats.reverse()
+        self.assertRenders(audio.AudioQuantumList(beats), assemble(beats))
+
+    def test_multiple_sources(self):
+        quanta = [quantum(self.a, 0.5), quantum(self.b, 1.0, 0.3), quantum(self.a, 2.0, 0.7)]
+        self.assertRenders(audio.AudioQuantumList(quanta), assemble(quanta))
+
+    def test_simultaneous(self):
+        first, second = quantum(self.a, 0.5), quantum(self.b, 1.0, 0.7)
+        expected = piece(second)
+        expected[:len(piece(first))] += piece(first)
+        self.assertRenders(audio.Simultaneous([first, second]), expected)
+
+    def test_nested(self):
+        both = [quantum(self.a, 0.5), quantum(self.b, 1.0)]
+        after = quantum(self.a, 2.0)
+        expected = assemble([both[0], after])
+        expected[:len(piece(both[1]))] += piece(both[1])
+        self.assertRenders(audio.AudioQuantumList([audio.Simultaneous(both), after]), expected)
+
+    def test_compile(self):
+        quanta = [quantum(self.a, 1.0), quantum(self.b, 0.2)]
+        plan = audio.AudioQuantumList(quanta).compile()
+        self.assertEqual(plan.sources(), [self.a, self.b])
+        self.assertEqual(len(plan.entries), 2)
+        self.assertEqual(plan.minimum, len(assemble(quanta)))
+        numpy.testing.assert_array_equal(plan.render().data, assemble(quanta))
+
+    def test_modified(self):
+        aq = quantum(self.a, 0.5)
+        out = audio.ModifiedRenderable(aq, [audio.AmplitudeFactor(0.5)]).render()
+        self.assertTrue(isinstance(out, audio.AudioData32))
+        numpy.testing.assert_array_equal(out.data, (piece(aq) * 0.5).astype(numpy.int32))
+
+    def test_folded_effects_match_modify(self):
+        aq = quantum(self.a, 0.5)
+        for effects in ([audio.TimeTruncateFactor(1.5)],
+                        [audio.TimeTruncateLength(0.2), audio.AmplitudeFactor(2)],
+                        [audio.AmplitudeFactor(2), audio.TimeTruncateFactor(0.5)]):
+            folded = audio.ModifiedRenderable(aq, effects).render()
+            modified = audio.ModifiedRenderable(aq, [Unfolded(e) for e in effects]).render()
+            self.assertEqual(type(folded), type(modified))
+            self.assertEqual(folded.data.dtype, modified.data.dtype)
+            numpy.testing.assert_array_equal(folded.data, modified.data)
+
+    def test_modified_in_list(self):
+        first, second = quantum(self.a, 0.5), quantum(self.b, 1.0)
+        shorter = audio.TimeTruncateFactor(0.5)
+        quanta = [audio.ModifiedRenderable(first, [audio.AmplitudeFactor(2), shorter]), second]
+        expected = assemble([quantum(self.a, 0.5, 0.25), second])
+        expected[:len(piece(first)) // 2] *= 2
+        self.assertRenders(audio.AudioQuantumList(quanta), expected)
+
+    def test_mix_bus(self):
+        bus = audio.MixBus(len(self.a.data) + 100)
+        bus.add(self.a, 0.5)
+        bus.add(self.b, 0.25, offset=100)
+        out = bus.render(verbose=False)
+        self.assertEqual(type(out), audio.AudioData)
+        self.assertEqual(out.data.dtype, numpy.int16)
+        expected = numpy.zeros(out.data.shape)
+        expected[:-100] += self.a.data * 0.5
+        expected[100:] += self.b.data[:len(expected) - 100] * 0.25
+        # Well below the limiter's threshold, only rounding changes anything.
+        self.assertTrue(numpy.abs(out.data - expected).max() <= 1)
+
+    def test_mix_bus_limits_without_wrapping(self):
+        loud = numpy.linspace(-32767, 32767, 20000).astype(numpy.int16)
+        bus = audio.MixBus(len(loud), numChannels=1)
+        bus.add(loud)
+        bus.add(loud)
+        out = bus.render(verbose=False).data
+        self.assertTrue(numpy.abs(out.astype(numpy.int32)).max() <= 32767)
+        # Summed, the ramp would wrap around; limited, it still rises throughout.
+        self.assertTrue((numpy.diff(out.astype(numpy.int32)) >= 0).all())
+        quiet = numpy.abs(2 * loud.astype(numpy.int32)) < audio.LIMIT_THRESHOLD
+        numpy.testing.assert_array_equal(out[quiet], 2 * loud[quiet])
+
+    def test_mix_bus_spreads_mono(self):
+        mono = numpy.arange(1000, dtype=numpy.int16)
+        bus = audio.MixBus(500, numChannels=2)
+        bus.add(mono, offset=100)
+        out = bus.render(verbose=False).data
+        self.assertEqual(out.shape, (500, 2))
+        numpy.testing.assert_array_equal(out[100:, 0], mono[:400])
+        numpy.testing.assert_array_equal(out[:, 0], out[:, 1])
+
+class ThreadedRenderTest(RenderTest):
+    "Runs the same tests with every plan rendered from the thread pool."
+    def setUp(self):
+        RenderTest.setUp(self)
+        self.settings = audio.RENDER_THREADS, audio.RENDER_MIN_FRAMES
+        audio.RENDER_THREADS, audio.RENDER_MIN_FRAMES = 4, 0
+
+    def tearDown(self):
+        audio.RENDER_THREADS, audio.RENDER_MIN_FRAMES = self.settings
+
+    def test_matches_serial(self):
+        sources = [source(seed) for seed in xrange(6)]
+        quanta = [quantum(sources[i % 6], 0.1 * i, 0.4) for i in xrange(30)]
+        both = audio.Simultaneous([quantum(s, 1.0, 2.0) for s in sources])
+        threaded = audio.AudioQuantumList(quanta + [both]).render().data
+        audio.RENDER_THREADS = 1
+        serial = audio.AudioQuantumList(quanta + [both]).render().data
+        numpy.testing.assert_array_equal(threaded, serial)
+
+    def test_small_plans_render_serially(self):
+        audio.RENDER_MIN_FRAMES = 10 * 44100
+        plan = audio.Simultaneous([quantum(self.a, 0.5), quantum(self.b, 1.0)]).compile()
+        plan._execute_threaded = None
+        numpy.testing.assert_array_equal(plan.render().data, self.a.data[22050:44100] +
+                                         self.b.data[44100:66150].astype(numpy.int32))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Test `AudioAnalysis.resample` against the segment-by-segment loop that
+earworm used before, on a made-up analysis read from a local JSON file.
+
+Run the tests like this:
+    python test_resample.py
+"""
+
+import os
+import json
+import random
+import tempfile
+import unittest
+
+import numpy
+
+from echonest.remix import audio
+
+FUSION_INTERVAL = .06
+AVG_PEAK_OFFSET = 0.025
+
+class Quantum(object):
+    def __init__(self, quantum):
+        self.start = quantum.start
+        self.duration = quantum.duration
+        self.values = quantum
+
+def resample_features(analysis, rate='tatums', feature='timbre'):
+    """The loop over segments that `AudioAnalysis.resample` replaced."""
+    def central(member):
+        members = getattr(analysis, member)
+        ret = [Quantum(s) for s in members
+               if analysis.end_of_fade_in <= s.start and s.start + s.duration < analysis.start_of_fade_out]
+        index = [s.start for s in members].index(ret[0].start) if ret else 0
+        return ret, index
+    segments, unused = central('segments')
+    markers, index = central(rate)
+    if len(segments) < 2 or len(markers) < 2:
+        return numpy.zeros((0, 12), dtype=numpy.float32), index
+    # Find the optimal attack offset
+    offsets = []
+    if rate != 'segments':
+        i = 0
+        try:
+            for marker in markers:
+                while segments[i].start < marker.start + FUSION_INTERVAL:
+                    offset = abs(marker.start - segments[i].start)
+                    if offset < FUSION_INTERVAL:
+                        offsets.append(offset)
+                    i += 1
+        except IndexError:
+            pass
+        offset = numpy.average(offsets) if offsets else AVG_PEAK_OFFSET
+        for m in markers:
+            m.start = max(m.start - offset, 0)
+    mat = numpy.zeros((len(markers) - 1, 12), dtype=numpy.float32)
+    i = (j for j, s in enumerate(segments) if markers[0].start < s.start + s.duration).next()
+    try:
+        for (k, m) in enumerate(markers[:-1]):
+            while segments[i].start + segments[i].duration < m.start + m.duration:
+                dur = segments[i].duration
+                if segments[i].start < m.start:
+                    dur -= m.start - segments[i].start
+                mat[k] += min(dur / m.duration, 1) * numpy.array(getattr(segments[i].values, feature))
+                i += 1
+            C = min((m.duration + m.start - segments[i].start) / m.duration, 1)
+            mat[k] += C * numpy.array(getattr(segments[i].values, feature))
+    except IndexError:
+        pass
+    return mat, index
+
+def make_analysis(n, seed):
+    """A track of n half-second beats, with jittered beats and random segments."""
+    random.seed(seed)
+    d = {'id': 'TRTEST', 'md5': '0' * 32, 'duration': n * 0.5,
+         'end_of_fade_in': 1.1, 'start_of_fade_out': n * 0.5 - 1, 'loudness': -10}
+    for attribute in ('time_signature', 'mode', 'tempo', 'key'):
+        d[attribute] = 1
+        d[attribute + '_confidence'] = 0.5
+    d['beats'] = [{'start': i * 0.5 + random.uniform(0, 0.03), 'duration': 0.5, 'confidence': 0.3}
+                  for i in range(n)]
+    d['tatums'] = [{'start': i * 0.25, 'duration': 0.25, 'confidence': 0.3} for i in range(2 * n)]
+    d['bars'] = [{'start': i * 2.0, 'duration': 2.0, 'confidence': 0.3} for i in range(n // 4)]
+    d['sections'] = [{'start': 0.0, 'duration': n * 0.5, 'confidence': 1}]
+    segments = []
+    t = 0.0
+    while t < n * 0.5:
+        duration = random.uniform(0.05, 0.4)
+        segments.append({'start': t, 'duration': duration, 'confidence': .5,
+                         'loudness_start': -20, 'loudness_max': -10, 'loudness_max_time': 0.01,
+                         'pitches': [random.random() for i in range(12)],
+                         'timbre': [random.uniform(-50, 50) for i in range(12)]})
+        t += duration
+    d['segments'] = segments
+    fd, name = tempfile.mkstemp('.json')
+    with os.fdopen(fd, 'w') as f:
+        json.dump(d, f)
+    try:
+        return audio.AudioAnalysis(name, fromLocal=True)
+    finally:
+        os.unlink(name)
+
+class ResampleTest(unittest.TestCase):
+    def setUp(self):
+        self.analysis = make_analysis(200, 0)
+
+    def test_matches_segment_loop(self):
+        for level in ('tatums', 'beats', 'bars', 'segments'):
+            for feature in ('timbre', 'pitches'):
+                matrix, index = self.analysis.resample(level, feature)
+                expected, expected_index = resample_features(self.analysis, level, feature)
+                self.assertEqual(index, expected_index)
+                self.assertEqual(matrix.shape, expected.shape)
+                self.assertEqual(matrix.dtype, numpy.float32)
+                numpy.testing.assert_allclose(matrix, expected, rtol=1e-4, atol=1e-3)
+
+    def test_cached_and_read_only(self):
+        matrix, index = self.analysis.resample('beats')
+        self.assertTrue(self.analysis.resample('beats')[0] is matrix)
+        self.assertRaises((ValueError, RuntimeError), matrix.__setitem__, (0, 0), 1)
+
+    def test_too_short(self):
+        matrix, index = make_analysis(6, 1).resample('bars')
+        self.assertEqual(matrix.shape, (0, 12))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Test the tiled self-similarity matrices of `similarity` against distances
+worked out one pair at a time, and its loop points against the row-by-row
+search that earworm used before.
+
+Run the tests like this:
+    python test_similarity.py
+"""
+
+import os
+import operator
+import tempfile
+import unittest
+
+import numpy
+
+from echonest.remix import similarity
+
+def windows(features, window):
+    return numpy.array([features[i:i + window].ravel()
+                        for i in xrange(len(features) - window + 1)])
+
+def pairwise(points):
+    return numpy.sqrt(((points[:, numpy.newaxis] - points) ** 2).sum(axis=2))
+
+def get_loop_points(vector, size=16, max_edges=8, min_range=16):
+    """The loop over one row that `similarity.loop_points` replaced."""
+    res = set()
+    m = numpy.mean(vector)
+    s = numpy.std(vector)
+    for i in xrange(vector.size-size):
+        sub = vector[i:i+size]
+        j = numpy.argmin(sub)
+        if sub[j] < m-s and j != 0 and j != size-1 and sub[j] < sub[j-1] and sub[j] < sub[j+1] and sub[j] != 0:
+            res.add((i+j, sub[j]))
+    # let's remove clusters of minima
+    res = sorted(res, key=operator.itemgetter(0))
+    out = set()
+    i = 0
+    while i < len(res):
+        tmp = [res[i]]
+        j = 1
+        while i+j < len(res):
+            if res[i+j][0]-res[i+j-1][0] < min_range:
+                tmp.append(res[i+j])
+                j = j+1
+            else:
+                break
+        tmp = sorted(tmp, key=operator.itemgetter(1))
+        out.add(tmp[0])
+        i = i+j
+    out = sorted(out, key=operator.itemgetter(1))
+    return out[:max_edges]
+
+class SelfSimilarityTest(unittest.TestCase):
+    def setUp(self):
+        random = numpy.random.RandomState(0)
+        self.features = random.randn(100, 12) * 30 + 100
+        # A repeat, which must come out exactly zero apart.
+        self.features[60:70] = self.features[10:20]
+
+    def test_matches_pairwise(self):
+        for window in (1, 4):
+            expected = pairwise(windows(self.features, window))
+            matrix = similarity.self_similarity(self.features, window, block_size=16)
+            self.assertEqual(matrix.dtype, numpy.float32)
+            numpy.testing.assert_allclose(matrix, expected, rtol=1e-5, atol=1e-3)
+            numpy.testing.assert_array_equal(matrix, matrix.T)
+            numpy.testing.assert_array_equal(numpy.diag(matrix), 0)
+
+    def test_repeat_is_exactly_zero(self):
+        matrix = similarity.self_similarity(self.features, 4, block_size=16)
+        self.assertEqual(matrix[10, 60], 0)
+        self.assertEqual(matrix[16, 66], 0)
+
+    def test_on_disk(self):
+        fd, name = tempfile.mkstemp('.similarity')
+        os.close(fd)
+        try:
+            matrix = similarity.self_similarity(self.features, 4, filename=name, block_size=16)
+            self.assertTrue(isinstance(matrix, numpy.memmap))
+            numpy.testing.assert_array_equal(
+                matrix, similarity.self_similarity(self.features, 4, block_size=16))
+            del matrix
+        finally:
+            os.unlink(name)
+
+    def test_neighbours(self):
+        # Without the repeat, which makes ties.
+        features = numpy.random.RandomState(1).randn(100, 12)
+        k, exclude = 5, 3
+        expected = pairwise(windows(features, 2))
+        n = len(expected)
+        offsets = numpy.abs(numpy.arange(n)[:, numpy.newaxis] - numpy.arange(n))
+        expected[offsets < exclude] = numpy.inf
+        indices, distances = similarity.neighbours(features, k, window=2,
+                                                   exclude=exclude, block_size=16)
+        self.assertEqual(indices.shape, (n, k))
+        numpy.testing.assert_array_equal(indices, numpy.argsort(expected, axis=1)[:, :k])
+        numpy.testing.assert_allclose(distances, numpy.sort(expected, axis=1)[:, :k],
+                                      rtol=1e-5, atol=1e-3)
+
+    def test_neighbours_padding(self):
+        indices, distances = similarity.neighbours(self.features[:4], 5, exclude=1)
+        numpy.testing.assert_array_equal(indices[:, 3:], -1)
+        self.assertTrue(numpy.isinf(distances[:, 3:]).all())
+
+class LoopPointsTest(unittest.TestCase):
+    def test_matches_row_loop(self):
+        random = numpy.random.RandomState(2)
+        # A motif repeated with noise, so that rows have clear minima.
+        motif = random.randn(24, 12)
+        features = numpy.vstack([motif + 0.2 * random.randn(24, 12) for i in xrange(12)])
+        matrix = similarity.self_similarity(features, 4)
+        for size, max_edges, min_range in ((16, 8, 16), (8, 3, 4)):
+            rows, columns, values = similarity.loop_points(matrix, size, max_edges,
+                                                           min_range, block_size=32)
+            found = 0
+            for i, row in enumerate(matrix):
+                expected = get_loop_points(row, size, max_edges, min_range)
+                mine = rows == i
+                self.assertEqual(zip(columns[mine], values[mine]), expected)
+                found += len(expected)
+            self.assertEqual(len(rows), found)
+            self.assertTrue(found > len(matrix))
+
+    def test_single_row_and_no_candidates(self):
+        row = similarity.self_similarity(numpy.random.RandomState(3).randn(80, 12), 4)[40]
+        rows, columns, values = similarity.loop_points(row)
+        self.assertEqual(zip(columns, values), get_loop_points(row))
+        rows, columns, values = similarity.loop_points(numpy.ones((5, 40)))
+        self.assertEqual((len(rows), len(columns), len(values)), (0, 0, 0))
+
+if __name__ == '__main__':
+    unittest.main()
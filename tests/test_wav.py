@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Test reading and writing WAVE files in `AudioData`, including memory-mapped
+loading, without ffmpeg.
+
+Run the tests like this:
+    python test_wav.py
+"""
+
+import os
+import wave
+import shutil
+import tempfile
+import unittest
+
+import numpy
+
+from echonest.remix import audio
+
+def samples(frames=50000, channels=2):
+    return (numpy.arange(frames * channels) % 20000 - 10000).astype(numpy.int16).reshape((frames, channels))
+
+class WavTest(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.filename = os.path.join(self.folder, 'x.wav')
+        self.data = samples()
+        self.write(self.filename, self.data)
+        self.mmap = audio.MMAP_WAV
+
+    def tearDown(self):
+        audio.MMAP_WAV = self.mmap
+        shutil.rmtree(self.folder)
+
+    def write(self, filename, data):
+        audio.AudioData(ndarray=data, sampleRate=44100, numChannels=2, verbose=False).encode(filename)
+
+    def load(self, filename):
+        return audio.AudioData(filename, sampleRate=44100, numChannels=2, verbose=False)
+
+    def test_mmap_load(self):
+        audio.MMAP_WAV = True
+        loaded = self.load(self.filename)
+        self.assertTrue(isinstance(loaded.data, numpy.memmap))
+        self.assertEqual(loaded.data.shape, self.data.shape)
+        numpy.testing.assert_array_equal(loaded.data, self.data)
+
+    def test_copy_load(self):
+        audio.MMAP_WAV = False
+        loaded = self.load(self.filename)
+        self.assertFalse(isinstance(loaded.data, numpy.memmap))
+        numpy.testing.assert_array_equal(loaded.data, self.data)
+
+    def test_copy_on_write(self):
+        audio.MMAP_WAV = True
+        loaded = self.load(self.filename)
+        loaded.data[:100] = 0
+        self.assertTrue((loaded.data[:100] == 0).all())
+        numpy.testing.assert_array_equal(self.load(self.filename).data, self.data)
+
+    def test_other_sample_widths_are_read(self):
+        """Only 16-bit files are mapped; others are read as they used to be."""
+        audio.MMAP_WAV = True
+        filename = os.path.join(self.folder, 'wide.wav')
+        raw = numpy.arange(4000, dtype='<i4').tostring()
+        w = wave.open(filename, 'wb')
+        w.setnchannels(2)
+        w.setsampwidth(4)
+        w.setframerate(44100)
+        w.writeframes(raw)
+        w.close()
+        loaded = self.load(filename)
+        self.assertFalse(isinstance(loaded.data, numpy.memmap))
+        numpy.testing.assert_array_equal(loaded.data.ravel(),
+                                         numpy.frombuffer(raw, dtype='<h', count=4000))
+
+    def test_encode_over_mapped_source(self):
+        """Writing over the file a live map reads from must not crash."""
+        audio.MMAP_WAV = True
+        loaded = self.load(self.filename)
+        mode = os.stat(self.filename).st_mode & 0777
+        reversed_data = self.data[::-1].copy()
+        self.write(self.filename, reversed_data)
+        # The map still sees the old file.
+        numpy.testing.assert_array_equal(loaded.data, self.data)
+        loaded.encode(self.filename)
+        numpy.testing.assert_array_equal(self.load(self.filename).data, self.data)
+        self.assertEqual(os.stat(self.filename).st_mode & 0777, mode)
+        self.assertEqual(os.listdir(self.folder), ['x.wav'])
+
+if __name__ == '__main__':
+    unittest.main()
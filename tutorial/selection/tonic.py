@@ -10,6 +10,7 @@ Demonstrates content-based selection filtering via AudioQuantumLists
 Originally by Adam Lindsay, 2008-09-15.
 Refactored by Thor Kell, 2012-11-01
 """
+import numpy
 import echonest.remix.audio as audio
 
 usage = """
@@ -41,7 +42,7 @@ def main(units, inputFile, outputFile):
     tonic_segments = audio.AudioQuantumList(kind="segment")
     for segment in all_segments:
         pitches = segment.pitches
-        if pitches.index(max(pitches)) == tonic:
+        if int(numpy.argmax(pitches)) == tonic:
             tonic_segments.append(segment)
 
     # Find each chunk that matches each segment